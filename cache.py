@@ -0,0 +1,167 @@
+# http://inamidst.com/saxo/
+# Created by Sean B. Palmer
+
+# Results of commands which give the same answer for the same input for a
+# while, so that asking again doesn't run the command again
+
+import collections
+import threading
+import time
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import sqlite
+else:
+    import sqlite
+
+class Cache(object):
+    # Results are kept for as many seconds as each command allows, and the
+    # least recently used are dropped to keep within entries and size bytes
+    # With a database filename, results are also kept in saxo_cache, and
+    # load reads them back once the migrations have made the table
+    def __init__(self, entries=1024, size=1048576, database=None):
+        self.entries = entries
+        self.size = size
+        self.database = database
+        self.lock = threading.Lock()
+        self.results = collections.OrderedDict()
+        self.used = 0
+        self.counts = collections.Counter()
+
+    def load(self):
+        if self.database is None:
+            return
+
+        now = time.time()
+        with sqlite.database(self.database) as db:
+            if "saxo_cache" not in db:
+                return
+
+            db["saxo_cache"].delete(where="expires <= ?", params=(now,))
+            rows = db["saxo_cache"].select(order="expires")
+            for key, expires, text in list(rows):
+                self.store(key, text, expires)
+        self.evict()
+
+    def store(self, key, text, expires):
+        if key in self.results:
+            self.used -= len(self.results.pop(key)[1].encode("utf-8"))
+        self.results[key] = (expires, text)
+        self.used += len(text.encode("utf-8"))
+
+    def evict(self):
+        # Returns the keys that were dropped
+        evicted = []
+        while self.results and ((len(self.results) > self.entries) or
+                                (self.used > self.size)):
+            key, (expires, text) = self.results.popitem(last=False)
+            self.used -= len(text.encode("utf-8"))
+            evicted.append(key)
+        self.counts["evicted"] += len(evicted)
+        return evicted
+
+    def get(self, key):
+        # Returns the cached text for key, or None
+        key = repr(key)
+        with self.lock:
+            cached = self.results.get(key)
+            if cached is None:
+                self.counts["misses"] += 1
+                return None
+
+            expires, text = cached
+            if expires <= time.time():
+                self.used -= len(self.results.pop(key)[1].encode("utf-8"))
+                self.counts["misses"] += 1
+                self.counts["expired"] += 1
+                return None
+
+            self.results.move_to_end(key)
+            self.counts["hits"] += 1
+            return text
+
+    def put(self, key, text, ttl):
+        key = repr(key)
+        expires = time.time() + ttl
+        with self.lock:
+            self.store(key, text, expires)
+            evicted = self.evict()
+
+        if self.database is not None:
+            with sqlite.database(self.database) as db:
+                db["saxo_cache"].replace((key, expires, text), commit=False)
+                db.executemany("DELETE FROM saxo_cache WHERE key = ?",
+                    [(old,) for old in evicted])
+                db.commit()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.results),
+                "bytes": self.used,
+                "hits": self.counts["hits"],
+                "misses": self.counts["misses"],
+                "expired": self.counts["expired"],
+                "evicted": self.counts["evicted"]
+            }
+
+def test():
+    import os
+    import tempfile
+
+    # Results are kept until they expire
+    results = Cache()
+    results.put("a", "A", 0.2)
+    assert results.get("a") == "A"
+    time.sleep(0.3)
+    assert results.get("a") is None
+    assert results.stats()["expired"] == 1
+    assert results.stats()["bytes"] == 0
+
+    # The least recently used are dropped to keep within entries
+    results = Cache(entries=2)
+    results.put("a", "A", 60)
+    results.put("b", "B", 60)
+    assert results.get("a") == "A"
+    results.put("c", "C", 60)
+    assert results.get("b") is None
+    assert (results.get("a"), results.get("c")) == ("A", "C")
+
+    # And within size bytes
+    results = Cache(size=4)
+    results.put("a", "AA", 60)
+    results.put("b", "é", 60)
+    assert results.get("a") == "AA"
+    results.put("c", "C", 60)
+    assert results.get("b") is None
+    assert results.stats() == {"entries": 2, "bytes": 3, "hits": 1,
+        "misses": 1, "expired": 0, "evicted": 1}
+
+    # Persistent results are read back, apart from those which expired
+    handle, filename = tempfile.mkstemp(suffix=".sqlite3")
+    os.close(handle)
+    try:
+        with sqlite.Database(filename) as db:
+            db["saxo_cache"].create(
+                ("key", "TEXT PRIMARY KEY"),
+                ("expires", float),
+                ("text", str))
+        results = Cache(entries=2, database=filename)
+        results.put("a", "A", 60)
+        results.put("b", "B", 0.2)
+        results.put("c", "C", 60)
+        results.put("a", "A2", 60)
+        time.sleep(0.3)
+
+        results = Cache(database=filename)
+        results.load()
+        assert results.get("a") == "A2"
+        assert results.get("b") is None
+        assert results.get("c") == "C"
+        with sqlite.Database(filename) as db:
+            assert len(list(db["saxo_cache"])) == 2
+    finally:
+        os.remove(filename)
+
+if __name__ == "__main__":
+    test()
@@ -7,6 +7,7 @@ import base64
 import collections
 import os
 import pickle
+import queue
 import signal
 import socket
 import sys
@@ -60,10 +61,13 @@ def error(short, long=None, err=None, code=1):
         print("        %s" % err)
     sys.exit(code)
 
-def exit_cleanly():
+def exit_cleanly(cleanup=None):
     def quit(signum, frame):
         print("Exiting cleanly (SIG %s)" % signum)
-        try: sys.exit()
+        try:
+            if cleanup is not None:
+                cleanup()
+            sys.exit()
         finally: os._exit(0)
 
     signal.signal(signal.SIGINT, quit)
@@ -126,6 +130,19 @@ def b64unpickle(data):
         return pickle.loads(pickled)
     return tuple()
 
+class Instructions(queue.Queue):
+    # Instructions for Saxo.handle, or for the Scheduler
+    def __init__(self):
+        queue.Queue.__init__(self)
+        # Called after every put, so that an event loop can wait for items
+        # without a thread blocked on get
+        self.notify = None
+
+    def put(self, item, *args, **kargs):
+        queue.Queue.put(self, item, *args, **kargs)
+        if self.notify is not None:
+            self.notify()
+
 def thread(target, *args):
     t = threading.Thread(target=target, args=tuple(args), daemon=True)
     t.start()
@@ -16,10 +16,10 @@
 # - Make sure the test server exits correctly
 # - Dump a copy of the initialised config to the database
 # - Document the database tables
-# - Delete and select methods for sqlite.Table
 
 import os
 import sys
+import threading
 
 from collections import namedtuple
 
@@ -65,34 +65,48 @@ __all__ = ["path", "version", "version_info"]
 #
 # saxo.command(*args, *, authorised=False, owner=False, private=False)
 # saxo.event(command="*")
+# saxo.migration(name, version)
 # saxo.pipe(function)
 # saxo.setup(function)
 #
 # Other:
 #
 # saxo.call(cmd, arg, methods=None)
+# saxo.casefold(text)
 # saxo.client(command, *args, base=None)
+# saxo.query(command, *args, base=None, timeout=10)
 # saxo.commands(methods=None)
 # saxo.database(name=None)
 # saxo.env(name)
 # saxo.request(*args, **kargs)
 # saxo.script(argv)
+# saxo.unicode_data(name=None, dotdir=False)
 # saxo.which(command, methods=None)
 
 # TODO: environment modification?
 
+# Commands run inside the saxo process keep their environment here, per thread
+context = threading.local()
+
 def public(function):
     __all__.append(function.__name__)
     return function
 
-@public
-def client(command, *args, base=None):
+def connect(command, args, base=None):
+    # Sends an instruction to saxo, and returns the socket it was sent on
     import base64
     import pickle
     import socket
 
     if base is None:
-        base = os.environ["SAXO_BASE"]
+        base = env("base")
+        if base is None:
+            raise KeyError("SAXO_BASE")
+
+    # Instructions from a command go back to the network it was called on
+    network = env("network")
+    if network and ("@" not in command):
+        command = command + "@" + network
 
     sockname = os.path.join(base, "client.sock")
     client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -101,7 +115,40 @@ def client(command, *args, base=None):
     command = command.encode("ascii", "replace")
     pickled = pickle.dumps(args)
     client.send(command + b" " + base64.b64encode(pickled) + b"\n")
-    client.close()
+    return client
+
+@public
+def client(command, *args, base=None):
+    connect(command, args, base=base).close()
+
+@public
+def query(command, *args, base=None, timeout=10):
+    # Like client, but waits for the value that saxo sends back
+    import base64
+    import pickle
+
+    client = connect("?" + command, args, base=base)
+    client.settimeout(timeout)
+    try:
+        with client.makefile("rb") as f:
+            line = f.readline()
+    finally:
+        client.close()
+
+    if not line:
+        raise EOFError("No response to %s" % command)
+    return pickle.loads(base64.b64decode(line.rstrip(b"\n")))
+
+@public
+def casefold(text):
+    # Save PEP 3122!
+    if "." in __name__:
+        from . import sqlite
+    else:
+        import sqlite
+
+    # The same as CASEFOLD(text) in saxo.database queries
+    return sqlite.casefold(text)
 
 @public
 def command(*args, authorised=False, owner=False, private=False):
@@ -140,6 +187,10 @@ def command(*args, authorised=False, owner=False, private=False):
         raise ValueError("No such keyword argument: owner")
 
     def decorator(function):
+        if getattr(context, "pipes", None) is not None:
+            # The checks would use saxo's environment, not the message's
+            if authorised or private:
+                raise ValueError("Can't run authorised or private inside saxo")
         if authorised and (not env("authorised")):
             return
         if private and env("sender").startswith("#"):
@@ -215,9 +266,9 @@ def data(name, value=None, *, command=None, check=True, delete=False):
 def database(name=None, dotdir=False):
     # Save PEP 3122!
     if "." in __name__:
-        from .sqlite import Database
+        from . import sqlite
     else:
-        from sqlite import Database
+        import sqlite
 
     if name is None:
         base = env("base")
@@ -228,7 +279,13 @@ def database(name=None, dotdir=False):
                 raise ValueError("No SAXO_BASE found")
         name = os.path.join(base, "database.sqlite3")
 
-    return Database(name)
+    # The [database] settings, when saxo runs this as a command
+    options = env("database")
+    if options:
+        sqlite.configure(options)
+
+    # Inside saxo, this borrows one of its open connections
+    return sqlite.database(name)
 
 # saxo.database.path?
 # TODO: Does saxo.database().path work?
@@ -236,13 +293,17 @@ def database(name=None, dotdir=False):
 # saxo.env("base")
 # saxo.env("bot")
 # saxo.env("commands")
+# saxo.env("database")
 # saxo.env("nick")
 # saxo.env("sender")
 # saxo.env("url")
 
 @public
 def env(name, alternative=None):
-    return os.environ.get("SAXO_%s" % name.upper(), alternative)
+    environ = getattr(context, "environ", None)
+    if environ is None:
+        environ = os.environ
+    return environ.get("SAXO_%s" % name.upper(), alternative)
 
 # TODO: priority?
 @public
@@ -252,6 +313,15 @@ def event(command="*"):
         return function
     return decorate
 
+@public
+def migration(name, version):
+    # A change to the table called name, applied once by plugins/schema.py
+    # Changes to each name are applied in order of version, from 1
+    def decorate(function):
+        function.saxo_migration = (name, version)
+        return function
+    return decorate
+
 @public
 def pipe(function):
     # This gives you:
@@ -268,6 +338,11 @@ def pipe(function):
     # Doesn't work. Would probably have to do:
     # @saxo.command(name=__name__)
 
+    if getattr(context, "pipes", None) is not None:
+        # Being loaded to run inside saxo, so don't run it now
+        context.pipes.append(function)
+        return function
+
     # Save PEP 3122!
     if "." in __name__:
         from . import common
@@ -291,6 +366,18 @@ def pipe(function):
     else:
         arg = ""
 
+    result, code = invoke(function, arg)
+    if result is not None:
+        result = result.encode("utf-8", "replace")
+        sys.stdout.buffer.write(result + b"\n")
+        sys.stdout.flush()
+    # So that saxo doesn't keep an error as though it were a result
+    if code:
+        sys.exit(code)
+
+def invoke(function, arg):
+    # Used by pipe, and by saxo for commands that it runs itself
+    # Returns the text and an exit code, which is 1 for an error
     try: result = function(arg)
     except Exception as err:
         import traceback
@@ -308,15 +395,11 @@ def pipe(function):
             elif line_number != "?":
                 break
         where = "(%s:%s)" % (os.path.basename(filename), line_number)
-        result = python + " " + where
+        return python + " " + where, 1
 
-    if result is not None:
-        if not isinstance(result, str):
-            print("Error: expected str, got %s" % type(result))
-            return
-        result = result.encode("utf-8", "replace")
-        sys.stdout.buffer.write(result + b"\n")
-        sys.stdout.flush()
+    if (result is not None) and (not isinstance(result, str)):
+        return "Error: expected str, got %s" % type(result), 1
+    return result, 0
 
 @public
 def request(*args, **kargs):
@@ -344,12 +427,45 @@ def script(argv):
 
     main(argv, version)
 
+@public
+def unicode_data(name=None, dotdir=False):
+    # Save PEP 3122!
+    if "." in __name__:
+        from . import unidata
+    else:
+        import unidata
+
+    if name is None:
+        base = env("base")
+        if base is None:
+            if dotdir is True:
+                base = os.path.expanduser("~/.saxo")
+            else:
+                raise ValueError("No SAXO_BASE found")
+        name = os.path.join(base, "unicode.data")
+
+    # Use data.open() before data.get(codepoint), and fall back to the
+    # saxo_unicode table if it returns False
+    return unidata.data(name)
+
+@public
+def unicode_search(db, search):
+    # Save PEP 3122!
+    if "." in __name__:
+        from . import unidata
+    else:
+        import unidata
+
+    # Rows of the saxo_unicode table with names matching search, best first
+    return unidata.search_by_name(db, search)
+
 @public
 def call(cmd, arg, *, methods=None):
     import subprocess
     cmd = which(cmd, methods=methods)
     arg = arg.encode("utf-8", "replace")
-    output = subprocess.check_output([cmd, arg])
+    environ = getattr(context, "environ", None)
+    output = subprocess.check_output([cmd, arg], env=environ)
     return str(output, "utf-8").rstrip("\r\n")
 
 def _commands(*, methods=None):
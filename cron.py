@@ -0,0 +1,165 @@
+# http://inamidst.com/saxo/
+# Created by Sean B. Palmer
+
+# Cron expressions for periodic tasks, in UTC. There are five fields, the
+# minute, hour, day of the month, month, and day of the week, where Sunday
+# is 0 or 7. Each field is * or a list such as 1,3-5,10-20/2 or */15, and
+# months and days of the week may also be given by their names, like jan
+# or mon. As with cron, when both kinds of day are given, either matches
+
+import calendar
+import datetime
+import functools
+import time
+
+aliases = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *"
+}
+
+months = ("jan", "feb", "mar", "apr", "may", "jun",
+          "jul", "aug", "sep", "oct", "nov", "dec")
+days = ("sun", "mon", "tue", "wed", "thu", "fri", "sat")
+
+# lowest, highest, names
+fields = (
+    (0, 59, {}),
+    (0, 23, {}),
+    (1, 31, {}),
+    (1, 12, {name: n + 1 for (n, name) in enumerate(months)}),
+    (0, 7, {name: n for (n, name) in enumerate(days)})
+)
+
+def number(text, names):
+    text = text.lower()
+    if text in names:
+        return names[text]
+    if not text.isdigit():
+        raise ValueError("Not a number: %r" % text)
+    return int(text)
+
+def values(text, lowest, highest, names):
+    result = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = number(step, {})
+            if step < 1:
+                raise ValueError("Step must be at least 1: %r" % text)
+
+        if part == "*":
+            start, stop = lowest, highest
+        elif "-" in part:
+            start, stop = part.split("-", 1)
+            start, stop = number(start, names), number(stop, names)
+        else:
+            start = number(part, names)
+            stop = highest if (step > 1) else start
+
+        if not (lowest <= start <= stop <= highest):
+            raise ValueError("Out of range: %r" % text)
+        result.update(range(start, stop + 1, step))
+    return frozenset(result)
+
+class Cron(object):
+    def __init__(self, expression):
+        self.expression = expression
+        text = aliases.get(expression.strip().lower(), expression)
+        parts = text.split()
+        if len(parts) != 5:
+            raise ValueError("Expected five fields: %r" % expression)
+
+        sets = [values(part, *field) for (part, field) in zip(parts, fields)]
+        self.minutes, self.hours, self.days, self.months, weekdays = sets
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        # Whether the day of the month, and the day of the week, were given
+        self.restricted = (not parts[2].startswith("*"),
+                           not parts[4].startswith("*"))
+
+    def day(self, moment):
+        # Python counts Monday as 0, and cron counts Sunday as 0
+        weekday = (moment.weekday() + 1) % 7
+        if all(self.restricted):
+            return (moment.day in self.days) or (weekday in self.weekdays)
+        return (moment.day in self.days) and (weekday in self.weekdays)
+
+    def next(self, after):
+        # The first minute later than the unixtime after, or None
+        moment = datetime.datetime(*time.gmtime(after)[:5])
+        moment += datetime.timedelta(minutes=1)
+        # Long enough for February 29th on a particular day of the week
+        limit = moment.year + 28
+        while moment.year <= limit:
+            if moment.month not in self.months:
+                year = moment.year + (moment.month // 12)
+                moment = datetime.datetime(year, moment.month % 12 + 1, 1)
+            elif not self.day(moment):
+                moment = datetime.datetime(moment.year, moment.month,
+                    moment.day) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = datetime.datetime(moment.year, moment.month,
+                    moment.day, moment.hour) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return calendar.timegm(moment.utctimetuple())
+        return None
+
+@functools.lru_cache(maxsize=256)
+def parse(expression):
+    return Cron(expression)
+
+def test():
+    def at(*args):
+        return calendar.timegm(datetime.datetime(*args).utctimetuple())
+    # A Monday
+    start = at(2024, 1, 1)
+
+    # Lists, ranges, steps, and names
+    assert values("1-3,10", 0, 59, {}) == {1, 2, 3, 10}
+    assert values("*/15", 0, 59, {}) == {0, 15, 30, 45}
+    assert values("10-20/5", 0, 59, {}) == {10, 15, 20}
+    assert values("50/3", 0, 59, {}) == {50, 53, 56, 59}
+    assert values("jan,Mar-may", *fields[3]) == {1, 3, 4, 5}
+    assert Cron("0 0 * * sun").weekdays == Cron("0 0 * * 7").weekdays == {0}
+    assert Cron("0 0 * * mon-fri").weekdays == {1, 2, 3, 4, 5}
+
+    assert Cron("* * * * *").next(start) == at(2024, 1, 1, 0, 1)
+    assert Cron("*/15 * * * *").next(start) == at(2024, 1, 1, 0, 15)
+    assert Cron("30 9-17/4 * * *").next(start) == at(2024, 1, 1, 9, 30)
+    assert Cron("30 9-17/4 * * *").next(at(2024, 1, 1, 9, 30)) == \
+        at(2024, 1, 1, 13, 30)
+    assert Cron("0 0 1 mar *").next(start) == at(2024, 3, 1)
+    assert Cron("0 0 1 1 *").next(start) == at(2025, 1, 1)
+    assert Cron("0 12 * * fri").next(start) == at(2024, 1, 5, 12)
+    assert Cron("0 0 * * 7").next(start) == at(2024, 1, 7)
+    assert Cron("@daily").next(start) == at(2024, 1, 2)
+    assert Cron("0 0 29 2 *").next(start) == at(2024, 2, 29)
+    assert Cron("0 0 29 2 *").next(at(2024, 3, 1)) == at(2028, 2, 29)
+
+    # When both kinds of day are given, either matches
+    assert Cron("0 0 13 * *").next(start) == at(2024, 1, 13)
+    assert Cron("0 0 * * fri").next(start) == at(2024, 1, 5)
+    assert Cron("0 0 13 * fri").next(start) == at(2024, 1, 5)
+    assert Cron("0 0 13 * fri").next(at(2024, 1, 12)) == at(2024, 1, 13)
+    assert Cron("0 0 13 * fri").next(at(2024, 1, 13)) == at(2024, 1, 19)
+    assert Cron("0 0 */2 * *").next(at(2024, 1, 1)) == at(2024, 1, 3)
+
+    # Expressions which never match give up, rather than looking forever
+    assert Cron("0 0 30 2 *").next(start) is None
+    assert Cron("0 0 31 4,6,9,11 *").next(start) is None
+
+    for expression in ("* * * *", "60 * * * *", "* * 0 * *", "* * * 13 *",
+            "*/0 * * * *", "5-1 * * * *", "x * * * *", "* * * * sat-mon"):
+        try: Cron(expression)
+        except ValueError: ...
+        else: raise AssertionError(expression)
+
+if __name__ == "__main__":
+    test()
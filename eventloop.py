@@ -0,0 +1,405 @@
+# http://inamidst.com/saxo/
+# Created by Sean B. Palmer
+
+# An asyncio core for saxo, used when [client] core is "asyncio"
+# The socket, the scheduler, the IPC server, and commands all run in one
+# event loop, instead of in a thread each. Instructions are the same
+
+import asyncio
+import concurrent.futures
+import os
+import queue
+import ssl
+import subprocess
+import sys
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import common
+    from . import irc
+    from . import scheduler
+    from . import sqlite
+else:
+    import common
+    import irc
+    import scheduler
+    import sqlite
+
+debug = irc.debug
+
+# The event loop only keeps weak references to tasks, so keep them here
+tasks = set()
+
+def create_task(loop, coroutine):
+    task = loop.create_task(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+async def spawn(env, path, arg, timeout):
+    octets = irc.utf8(arg)
+    proc = await asyncio.create_subprocess_exec(irc.utf8(path), octets,
+        env=irc.utf8dict(env),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    communicate = proc.communicate(octets + b"\n")
+    try: outs, errs = await asyncio.wait_for(communicate, timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return None, 0
+    return outs, proc.returncode or 0
+
+async def spawn_lines(env, path, arg, timeout, lines, size, output):
+    octets = irc.utf8(arg)
+    proc = await asyncio.create_subprocess_exec(irc.utf8(path), octets,
+        env=irc.utf8dict(env),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    try:
+        proc.stdin.write(octets + b"\n")
+        proc.stdin.close()
+    except OSError:
+        ...
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    limited = irc.Lines(lines, size, output)
+    finished = False
+    timed_out = False
+    while limited.wanted():
+        remaining = deadline - loop.time()
+        read = proc.stdout.read(limited.wanted())
+        try: chunk = await asyncio.wait_for(read, max(0, remaining))
+        except asyncio.TimeoutError:
+            timed_out = True
+            break
+
+        if not chunk:
+            finished = True
+            break
+        limited.feed(chunk)
+
+    if finished:
+        limited.finish()
+    else:
+        proc.kill()
+    try: await asyncio.wait_for(proc.wait(), max(0, deadline - loop.time()))
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        timed_out = True
+
+    if timed_out:
+        return None, 0
+    return limited.sent, proc.returncode or 0
+
+async def process(env, cmd, path, arg, pool=None, resident=None, stream=None,
+        store=None, executor=None):
+    # The same as irc.process, without a thread for each command
+    loop = asyncio.get_event_loop()
+    timeout = irc.time_limit(env)
+
+    if stream is not None:
+        try: sent, code = await spawn_lines(env, path, arg, timeout, *stream)
+        except PermissionError:
+            return irc.E_PERMISSIONS
+        except FileNotFoundError:
+            return
+        return irc.streamed(cmd, sent, code)
+
+    result = None
+    if resident is not None:
+        result = await loop.run_in_executor(executor,
+            resident.run, path, arg, env, timeout)
+
+    if (result is None) and (pool is not None) and pool.python(path):
+        try: result = await loop.run_in_executor(executor,
+            pool.run, path, arg, env, timeout)
+        except PermissionError:
+            return irc.E_PERMISSIONS
+
+    if result is None:
+        try: result = await spawn(env, path, arg, timeout)
+        except PermissionError:
+            return irc.E_PERMISSIONS
+        except FileNotFoundError:
+            return
+
+    text = irc.response(cmd, *result)
+    if (store is not None) and (result[0] is not None) and (not result[1]):
+        store(text)
+    return text
+
+def active(task):
+    return (task is not None) and (not task.done())
+
+class Saxo(irc.Saxo):
+    def __init__(self, base, opt, loop, network=None, master=None):
+        irc.Saxo.__init__(self, base, opt, network=network, master=master)
+        self.loop = loop
+        self.writer = None
+        self.receiving_task = None
+        self.sending_task = None
+        self.executor = None
+
+        # Set whenever something is put on the incoming or outgoing queues
+        self.instructable = asyncio.Event()
+        self.sendable = asyncio.Event()
+
+        def instructable():
+            loop.call_soon_threadsafe(self.instructable.set)
+        self.incoming.notify = instructable
+
+        def sendable():
+            loop.call_soon_threadsafe(self.sendable.set)
+        self.outgoing.notify = sendable
+
+    async def run(self, sockname):
+        self.setup_commands()
+        self.load()
+
+        await self.serve(sockname)
+        create_task(self.loop, self.schedule())
+
+        await self.open()
+        await self.handle()
+
+    def setup_commands(self):
+        irc.Saxo.setup_commands(self)
+        # Resident and pooled commands wait in threads of their own, enough
+        # for every command that can be admitted at once
+        threads = self.admission.total or 32
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+    async def serve(self, sockname):
+        if os.path.exists(sockname):
+            os.remove(sockname)
+
+        async def connection(reader, writer):
+            def reply(value):
+                octets = common.b64pickle(value) + b"\n"
+                self.loop.call_soon_threadsafe(writer.write, octets)
+
+            try:
+                while True:
+                    octets = await reader.readline()
+                    if not octets:
+                        break
+                    instruction = irc.parse_instruction
+                    try: irc.incoming.put(instruction(octets, reply))
+                    except Exception as err:
+                        debug("ERROR!", err.__class__.__name__, err)
+            finally:
+                writer.close()
+
+        await asyncio.start_unix_server(connection, path=sockname)
+        os.chmod(sockname, 0o600)
+
+    async def schedule(self):
+        backend = self.opt["client"].get("scheduler")
+        sched = scheduler.Scheduler(irc.incoming, backend)
+
+        # Set whenever the scheduler is sent an instruction
+        instructed = asyncio.Event()
+        def notify():
+            self.loop.call_soon_threadsafe(instructed.set)
+        scheduler.incoming.notify = notify
+
+        database_filename = os.path.join(self.base, "database.sqlite3")
+        with sqlite.Database(database_filename) as sched.db:
+            # Saxo sends load once plugins have migrated the tables
+            sched.message("initialised, waiting for instructions")
+            while True:
+                instructed.clear()
+                if not sched.tick(wait=False):
+                    break
+                sched.tock()
+                try: await asyncio.wait_for(instructed.wait(), sched.timeout())
+                except asyncio.TimeoutError:
+                    ...
+
+    async def handle(self):
+        while True:
+            self.instructable.clear()
+            while True:
+                try: instruction_args = self.incoming.get_nowait()
+                except queue.Empty:
+                    break
+                self.instruct(instruction_args)
+            await self.instructable.wait()
+
+    async def open(self):
+        host = self.opt["server"]["host"]
+        port = int(self.opt["server"]["port"])
+
+        context = None
+        if "ssl" in self.opt["server"]:
+            debug("Warning: Using SSL, but not validating the cert!")
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE # TODO: or CERT_REQUIRED
+
+        debug("Connecting to %s:%s" % (host, port))
+        try: reader, self.writer = await asyncio.open_connection(host, port,
+            ssl=context)
+        except Exception as err:
+            raise irc.SaxoConnectionError(str(err))
+
+        self.first = True
+        self.flood_limit()
+        self.receiving_task = create_task(self.loop, self.receive(reader))
+        self.sending_task = create_task(self.loop, self.transmit(self.writer))
+
+    async def receive(self, reader):
+        self.incoming.put(("receiving",))
+        try:
+            while True:
+                octets = await reader.readline()
+                if not octets:
+                    break
+                self.incoming.put(("remote", octets))
+        except Exception as err:
+            debug(str(err))
+        self.incoming.put(("disco_receiving",))
+
+    async def transmit(self, writer):
+        self.incoming.put(("sending",))
+        try:
+            while True:
+                self.sendable.clear()
+                ready, value = self.outgoing.take()
+                if ready:
+                    if value is None:
+                        debug("Sending Task: Requested quit")
+                        break
+                    debug("->", repr(value.decode("utf-8", "replace")))
+                    writer.write(value)
+                    await writer.drain()
+                    continue
+
+                try: await asyncio.wait_for(self.sendable.wait(), value)
+                except asyncio.TimeoutError:
+                    ...
+        except Exception as err:
+            debug("Sending Task: Error:", err)
+        self.incoming.put(("disco_sending",))
+
+    async def connecting(self, delay):
+        if self.socket_threads_active():
+            # Wait up to six seconds for the tasks to quit
+            for attempt in range(12):
+                await asyncio.sleep(0.5)
+                if not self.socket_threads_active():
+                    break
+            else:
+                debug("ERROR! Unable to stop the socket tasks")
+                irc.exit(1)
+
+        if "flood" not in self.opt["client"]:
+            await asyncio.sleep(3)
+
+        try: await self.open()
+        except irc.SaxoConnectionError as err:
+            # Retry, with 1sec more delay, up to a maximum of 30sec delay
+            self.loop.call_later(delay, self.incoming.put,
+                ("connect", min(30, delay + 1)))
+
+    async def execute(self, env, cmd, path, arg, destination,
+            key=None, store=None):
+        outs = None
+        try:
+            stream = self.stream(cmd, destination)
+            outs = await process(env, cmd, path, arg, pool=self.pool,
+                resident=self.resident, stream=stream, store=store,
+                executor=self.executor)
+        finally:
+            self.finished(env, destination, key, outs)
+
+    def start(self, env, cmd, path, arg, destination, key=None, store=None):
+        job = (env, cmd, path, arg, destination, key, store)
+        create_task(self.loop, self.execute(*job))
+
+    def disconnect(self):
+        if self.writer is not None:
+            self.writer.transport.abort()
+        self.cancel_discotimer()
+
+    def socket_threads_active(self):
+        receiving = active(self.receiving_task)
+        sending = active(self.sending_task)
+        debug("RECV, SEND:", receiving, sending)
+        return receiving or sending
+
+    def instruction_connect(self, delay=5):
+        create_task(self.loop, self.connecting(delay))
+
+    def instruction_reconnect(self):
+        if self.receiving or active(self.receiving_task):
+            self.disconnect()
+        elif self.sending or active(self.sending_task):
+            self.outgoing.put(None)
+        else:
+            debug("Reconnect requested during reconnect")
+
+class Networks(irc.Networks):
+    def __init__(self, saxos, loop):
+        irc.Networks.__init__(self, saxos)
+        self.loop = loop
+        self.routable = asyncio.Event()
+
+        def routable():
+            loop.call_soon_threadsafe(self.routable.set)
+        irc.incoming.notify = routable
+
+    def setup(self):
+        irc.Networks.setup(self)
+        for saxo in self.saxos.values():
+            saxo.executor = self.primary.executor
+
+    async def run(self, sockname):
+        self.setup()
+        await self.primary.serve(sockname)
+        create_task(self.loop, self.primary.schedule())
+
+        # Connecting is an instruction, so that failures are retried
+        for saxo in self.saxos.values():
+            saxo.incoming.put(("connect",))
+            create_task(self.loop, saxo.handle())
+
+        while True:
+            self.routable.clear()
+            while True:
+                try: instruction_args = irc.incoming.get_nowait()
+                except queue.Empty:
+                    break
+                self.route(instruction_args)
+            await self.routable.wait()
+
+def start(base, opt, sockname, names=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # Before python 3.12, the default watches each subprocess with a thread
+    if (sys.version_info < (3, 12)) and hasattr(os, "pidfd_open"):
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+            watcher = asyncio.PidfdChildWatcher()
+        except (AttributeError, OSError):
+            ...
+        else:
+            watcher.attach_loop(loop)
+            asyncio.set_child_watcher(watcher)
+
+    if names:
+        saxos = []
+        for name in names:
+            view = irc.network_options(opt, name)
+            saxos.append(Saxo(base, view, loop, network=name, master=opt))
+        networks = Networks(saxos, loop)
+        common.exit_cleanly(networks.primary.cleanup)
+        loop.run_until_complete(networks.run(sockname))
+    else:
+        saxo = Saxo(base, opt, loop)
+        common.exit_cleanly(saxo.cleanup)
+        loop.run_until_complete(saxo.run(sockname))
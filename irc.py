@@ -7,8 +7,8 @@ import configparser
 import imp
 import importlib
 import os.path
-import queue
 import re
+import select
 import signal
 import socket
 import subprocess
@@ -18,15 +18,19 @@ import time
 
 # Save PEP 3122!
 if "." in __name__:
+    from . import cache
     from . import common
     from . import scheduler
     from . import sqlite
+    from . import workers
     from .saxo import path as saxo_path
     from .saxo import version as saxo_version
 else:
+    import cache
     import common
     import scheduler
     import sqlite
+    import workers
     from saxo import path as saxo_path
     from saxo import version as saxo_version
 
@@ -55,8 +59,7 @@ def exit(code):
 # serve.listen
 # every serve.connection instance
 
-incoming = queue.Queue()
-outgoing = queue.Queue()
+incoming = common.Instructions()
 
 regex_optional_prefix = re.compile(r"(?::([^! ]*)!?([^@ ]*)@?([^ ]*))?")
 regex_parameter = re.compile(r"((?:(?<= :)[^\r\n]*)|(?:[^: \r\n][^ \r\n]*))")
@@ -94,6 +97,10 @@ class Message(object):
             saxo.send("PRIVMSG", *args)
         self.msg = msg
 
+        def client(*args):
+            saxo.incoming.put(args)
+        self.client = client
+
         if self.command == "PRIVMSG":
             self.sender = self.parameters[0]
             self.text = self.parameters[1]
@@ -148,11 +155,8 @@ class Message(object):
             return matches and self.identified
         return matches
 
-    def client(self, *args):
-        incoming.put(args)
-
 # threaded
-def socket_receive(sock):
+def socket_receive(sock, incoming):
     def receive_loop(sock, incoming):
         with sock.makefile("rb") as s:
             # TODO: How do we know when we're connected?
@@ -166,26 +170,94 @@ def socket_receive(sock):
         debug(str(err))
     incoming.put(("disco_receiving",))
 
-def flood_protection(recent):
-    recent.append(time.monotonic())
-    if len(recent) > 3:
-        recent.popleft()
-        if (recent[2] - recent[0]) < 2:
-            # debug("sleeping 1")
-            time.sleep(1)
-        elif (recent[2] - recent[1]) < 1:
-            # debug("sleeping 0.5")
-            time.sleep(0.5)
-        # else:
-        #     debug("sleeping 0")
-    else:
-        # debug("sleeping 0.25")
-        time.sleep(0.25)
+class Outgoing(object):
+    # Messages waiting to be sent. Protocol messages go first, and other
+    # messages have a queue per destination, with the queues taking turns
+    # A token bucket keeps the sending rate within server flood limits
+    priority = {b"JOIN", b"NICK", b"PART", b"PASS",
+                b"PING", b"PONG", b"QUIT", b"USER"}
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.urgent = collections.deque()
+        self.queues = collections.OrderedDict()
+        self.rate = None
+        self.burst = 1
+        self.tokens = 0
+        self.updated = time.monotonic()
+        # Called after every put, so that an event loop knows to send
+        self.notify = None
+
+    def limit(self, rate, burst):
+        # A rate of None means no limit
+        with self.condition:
+            self.rate = rate
+            self.burst = burst
+            self.tokens = burst
+            self.updated = time.monotonic()
+
+    def put(self, octets):
+        with self.condition:
+            if octets is None:
+                self.urgent.append(None)
+            else:
+                words = octets.rstrip(b"\r\n").split(b" ", 2)
+                if words[0].upper() in self.priority:
+                    self.urgent.append(octets)
+                else:
+                    target = words[1].lower() if (len(words) > 1) else b""
+                    if target not in self.queues:
+                        self.queues[target] = collections.deque()
+                    self.queues[target].append(octets)
+            self.condition.notify()
+        if self.notify is not None:
+            self.notify()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens += (now - self.updated) * self.rate
+        self.tokens = min(self.tokens, self.burst)
+        self.updated = now
+
+    def take(self):
+        # Returns (True, octets) if there's something to send now
+        # Otherwise (False, seconds until there might be), None for unknown
+        with self.condition:
+            if self.urgent and (self.urgent[0] is None):
+                return True, self.urgent.popleft()
+
+            if not (self.urgent or self.queues):
+                return False, None
+
+            if self.rate is not None:
+                self.refill()
+                if self.tokens < 1:
+                    return False, (1 - self.tokens) / self.rate
+                self.tokens -= 1
+
+            if self.urgent:
+                return True, self.urgent.popleft()
+
+            target, messages = self.queues.popitem(last=False)
+            octets = messages.popleft()
+            if messages:
+                self.queues[target] = messages
+            return True, octets
+
+    def get(self):
+        with self.condition:
+            while True:
+                ready, value = self.take()
+                if ready:
+                    return value
+                # Something more urgent may arrive while waiting
+                self.condition.wait(value)
+
+outgoing = Outgoing()
 
 # threaded
-def socket_send(sock, flood=False):
-    def sending(sock, flood=False):
-        recent = collections.deque()
+def socket_send(sock, incoming, outgoing):
+    def sending(sock):
         with sock.makefile("wb") as s:
             incoming.put(("sending",))
             while True:
@@ -197,14 +269,11 @@ def socket_send(sock, flood=False):
                 debug("->", repr(octets.decode("utf-8", "replace")))
                 s.write(octets)
                 s.flush()
-
-                if not flood:
-                    flood_protection(recent)
         # TODO: Surely this is never reached?
         debug("Sending Thread: No more data")
         return False
 
-    try: sending(sock, flood)
+    try: sending(sock)
     except Exception as err:
         # Usually BrokenPipeError
         debug("Sending Thread: Error:", err)
@@ -215,13 +284,186 @@ class SaxoConnectionError(Exception):
 
 regex_link = re.compile(r"(http[s]?://[^<> \"\x01]+)[,.]?")
 
-def command_path(base, cmd):
-    if ("\x00" in cmd) or (os.sep in cmd) or ("." in cmd):
-        return None
-    path = os.path.join(base, "commands", cmd)
-    if (not os.path.isfile(path)) or (not os.path.getsize(path)):
-        return None
-    return path
+def inotify(directory, callback):
+    # Calls callback whenever directory changes, if inotify is available
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError, TypeError):
+        return False
+    if fd < 0:
+        return False
+
+    # CREATE, DELETE, MOVED_FROM, MOVED_TO, MODIFY, ATTRIB, CLOSE_WRITE
+    mask = 0x100 | 0x200 | 0x40 | 0x80 | 0x2 | 0x4 | 0x8
+    wd = libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+    if wd < 0:
+        os.close(fd)
+        return False
+
+    def field(events, offset):
+        return int.from_bytes(events[offset:offset + 4], sys.byteorder)
+
+    def watch(fd):
+        while True:
+            try: events = os.read(fd, 4096)
+            except OSError:
+                events = b""
+
+            # IN_IGNORED means that the directory itself has gone
+            ignored = not events
+            offset = 0
+            while (offset + 16) <= len(events):
+                if field(events, offset + 4) & 0x8000:
+                    ignored = True
+                offset += 16 + field(events, offset + 12)
+
+            callback(not ignored)
+            if ignored:
+                os.close(fd)
+                break
+    common.thread(watch, fd)
+    return True
+
+class CommandIndex(object):
+    # Command paths, so that looking up a command doesn't touch the disk
+    def __init__(self, base, interval=1):
+        self.directory = os.path.join(base, "commands")
+        self.interval = interval
+        self.paths = {}
+        self.mtime = None
+        self.checked = 0
+        self.stale = True
+        self.notified = False
+
+    def build(self):
+        if not self.notified:
+            self.notified = inotify(self.directory, self.changed)
+
+        self.stale = False
+        try: self.mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            self.mtime = None
+
+        paths = {}
+        try: names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        for name in names:
+            if ("\x00" in name) or ("." in name):
+                continue
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path) and os.path.getsize(path):
+                paths[name] = path
+        self.paths = paths
+
+    def changed(self, watching):
+        self.stale = True
+        if not watching:
+            self.notified = False
+
+    def path(self, cmd):
+        if not self.notified:
+            now = time.monotonic()
+            if (now - self.checked) >= self.interval:
+                self.checked = now
+                try: mtime = os.stat(self.directory).st_mtime
+                except OSError:
+                    mtime = None
+                if mtime != self.mtime:
+                    self.stale = True
+
+        if self.stale:
+            self.build()
+        return self.paths.get(cmd)
+
+# Variables which are different for each message
+message_variables = {"AUTHORISED", "NICK", "SENDER", "URL"}
+
+regex_variable = re.compile(rb"SAXO_([A-Z]+)|env\(\s*[\"']([a-z]+)[\"']")
+regex_call = re.compile(rb"call\(\s*[\"']([^\"'\s]+)[\"']")
+regex_cache = re.compile(rb"(?m)^#\s*cache:\s*(\d+)([ \tA-Za-z_]*)$")
+
+def cache_option(text):
+    # "3600 url", or a header "# cache: 3600 url", as (3600, {"URL"})
+    # Without variable names, the variables are found from the script
+    words = text.split()
+    names = {word.upper().replace("SAXO_", "", 1) for word in words[1:]}
+    return int(words[0]), (names or None)
+
+class Scripts(object):
+    # What command scripts use, found by reading them, until they change
+    def __init__(self, commands):
+        self.commands = commands
+        self.lock = threading.Lock()
+        self.scripts = {}
+
+    def read(self, path):
+        try: mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+
+        with self.lock:
+            cached = self.scripts.get(path)
+        if cached and (cached[0] == mtime):
+            return cached[1]
+
+        with open(path, "rb") as f:
+            source = f.read()
+        variables = set()
+        for match in regex_variable.finditer(source):
+            name = match.group(1) or match.group(2).upper()
+            variables.add(name.decode("ascii"))
+        calls = {cmd.decode("utf-8", "replace")
+            for cmd in regex_call.findall(source)}
+        # Other processes could be given any of the variables
+        if (b"environ" in source) or (b"subprocess" in source):
+            variables |= message_variables
+        # saxo.command checks these for its authorised and private options
+        if b"saxo.command" in source:
+            variables |= {"AUTHORISED", "SENDER"}
+
+        header = regex_cache.search(source)
+        if header is not None:
+            header = cache_option((header.group(1) + header.group(2)).decode())
+
+        info = (variables & message_variables, calls, header)
+        with self.lock:
+            self.scripts[path] = (mtime, info)
+        return info
+
+    def cache(self, path):
+        # The cache header of a command, or None
+        try: info = self.read(path)
+        except OSError:
+            return None
+        return info[2] if info else None
+
+    def variables(self, path):
+        # Per message variables used by a command, or commands it calls
+        found = set()
+        paths = [path]
+        seen = set()
+        while paths:
+            path = paths.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+
+            try: info = self.read(path)
+            except OSError:
+                info = None
+            if info is None:
+                return message_variables
+            found |= info[0]
+            for cmd in info[1]:
+                called = self.commands.path(cmd)
+                if called is None:
+                    return message_variables
+                paths.append(called)
+        return found
 
 def utf8(obj):
     return str(obj).encode("utf-8", "replace")
@@ -229,45 +471,323 @@ def utf8(obj):
 def utf8dict(data):
     return {utf8(key): utf8(value) for key, value in data.items()}
 
-def process(env, cmd, path, arg):
+def spawn(env, path, arg, timeout):
     path = utf8(path)
     env = utf8dict(env)
     octets = utf8(arg)
 
-    try: proc = subprocess.Popen([path, octets], env=env,
+    proc = subprocess.Popen([path, octets], env=env,
         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    except PermissionError:
-        outs = "The command file does not have executable permissions"
-    except FileNotFoundError:
-        # Might have been removed just after running this thread
-        return
+
+    try: outs, errs = proc.communicate(octets + b"\n", timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        return None, 0
+
+    # Otherwise: TypeError: unorderable types: NoneType() > int()
+    return outs, proc.returncode or 0
+
+class Lines(object):
+    # Gives each complete line of output to a function, up to a maximum
+    # number of lines and of bytes
+    def __init__(self, lines, size, output):
+        self.lines = lines
+        self.size = size
+        self.output = output
+        self.buffer = b""
+        self.received = 0
+        self.sent = 0
+
+    def wanted(self):
+        if (self.sent < self.lines) and (self.received < self.size):
+            return min(4096, self.size - self.received)
+        return 0
+
+    def feed(self, chunk):
+        self.received += len(chunk)
+        self.buffer += chunk
+
+        while (b"\n" in self.buffer) and (self.sent < self.lines):
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            self.send(line)
+
+    def send(self, line):
+        line = line.decode("utf-8", "replace").rstrip("\r")
+        if line:
+            self.output(line)
+            self.sent += 1
+
+    def finish(self):
+        if self.sent < self.lines:
+            self.send(self.buffer)
+        self.buffer = b""
+
+def spawn_lines(env, path, arg, timeout, lines, size, output):
+    # Like spawn, but gives each line to output as soon as it arrives
+    # Stops the process after the given number of lines or bytes
+    octets = utf8(arg)
+    proc = subprocess.Popen([utf8(path), octets], env=utf8dict(env),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    try:
+        proc.stdin.write(octets + b"\n")
+        proc.stdin.close()
+    except OSError:
+        ...
+
+    fd = proc.stdout.fileno()
+    deadline = time.monotonic() + timeout
+    limited = Lines(lines, size, output)
+    finished = False
+    timed_out = False
+    while limited.wanted():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            timed_out = True
+            break
+        if not select.select([fd], [], [], remaining)[0]:
+            continue
+
+        chunk = os.read(fd, limited.wanted())
+        if not chunk:
+            finished = True
+            break
+        limited.feed(chunk)
+
+    if finished:
+        limited.finish()
     else:
-        authorised = "SAXO_AUTHORISED" in env
-        private = not env.get("SAXO_SENDER", "#").startswith("#")
-        timeout = 36 if (authorised and private) else 12
-
-        try: outs, errs = proc.communicate(octets + b"\n", timeout=timeout)
-        except subprocess.TimeoutExpired:
-            proc.kill()
-            # TODO: Use actual prefix
-            outs = "Sorry, %s took too long" % cmd
-        else:
-            outs = outs.decode("utf-8", "replace")
-            if "\n" in outs:
-                outs = outs.splitlines()[0]
-
-        code = proc.returncode or 0
-        # Otherwise: TypeError: unorderable types: NoneType() > int()
-        if (code > 0) and (not outs):
-            # TODO: Use actual prefix
-            outs = "Sorry, %s responded with an error" % cmd
+        proc.kill()
+    proc.stdout.close()
+    try: proc.wait(timeout=max(0, deadline - time.monotonic()))
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        timed_out = True
+
+    if timed_out:
+        return None, 0
+    return limited.sent, proc.returncode or 0
+
+def time_limit(env):
+    authorised = "SAXO_AUTHORISED" in env
+    private = not env.get("SAXO_SENDER", "#").startswith("#")
+    return 36 if (authorised and private) else 12
+
+def response(cmd, outs, code):
+    # Makes the text to send from the result of running a command
+    if outs is None:
+        # TODO: Use actual prefix
+        return "Sorry, %s took too long" % cmd
+
+    outs = outs.decode("utf-8", "replace")
+    if "\n" in outs:
+        outs = outs.splitlines()[0]
+
+    if (code > 0) and (not outs):
+        # TODO: Use actual prefix
+        outs = "Sorry, %s responded with an error" % cmd
     return outs
 
+def streamed(cmd, sent, code):
+    # Like response, for streamed commands, which have sent their output
+    if sent is None:
+        return "Sorry, %s took too long" % cmd
+    if (code > 0) and (not sent):
+        return "Sorry, %s responded with an error" % cmd
+    return None
+
+E_PERMISSIONS = "The command file does not have executable permissions"
+
+def values(env, variables):
+    # The values of per message variables, for telling commands apart
+    return tuple((name, env.get("SAXO_" + name)) for name in sorted(variables))
+
+def process(env, cmd, path, arg, pool=None, resident=None, stream=None,
+        store=None):
+    # If the command succeeds, store is called with its response
+    timeout = time_limit(env)
+
+    if stream is not None:
+        # Streamed output only comes from a process of its own
+        try: sent, code = spawn_lines(env, path, arg, timeout, *stream)
+        except PermissionError:
+            return E_PERMISSIONS
+        except FileNotFoundError:
+            return
+        return streamed(cmd, sent, code)
+
+    result = None
+    if resident is not None:
+        result = resident.run(path, arg, env, timeout)
+
+    if (result is None) and (pool is not None) and pool.python(path):
+        try: result = pool.run(path, arg, env, timeout)
+        except PermissionError:
+            return E_PERMISSIONS
+
+    if result is None:
+        try: result = spawn(env, path, arg, timeout)
+        except PermissionError:
+            return E_PERMISSIONS
+        except FileNotFoundError:
+            # Might have been removed just after running this thread
+            return
+
+    text = response(cmd, *result)
+    if (store is not None) and (result[0] is not None) and (not result[1]):
+        store(text)
+    return text
+
+class Admission(object):
+    # Limits how many commands run at once: in total, for each nick, and for
+    # each channel. Commands over a limit wait in a bounded queue, and are
+    # rejected when it's full. A limit of None means no limit
+    def __init__(self, total=None, nick=None, channel=None, waiting=0):
+        self.lock = threading.Lock()
+        self.total = total
+        self.nick = nick
+        self.channel = channel
+        self.waiting = waiting
+        self.queue = collections.deque()
+        self.running = 0
+        self.nicks = collections.Counter()
+        self.channels = collections.Counter()
+        self.counts = collections.Counter()
+        # Destinations told about a rejection, until a command is admitted
+        self.rejections = set()
+
+    def allowed(self, nick, channel):
+        if (self.total is not None) and (self.running >= self.total):
+            return False
+        if (nick is not None) and (self.nick is not None):
+            if self.nicks[nick] >= self.nick:
+                return False
+        if (channel is not None) and (self.channel is not None):
+            if self.channels[channel] >= self.channel:
+                return False
+        return True
+
+    def take(self, nick, channel):
+        self.running += 1
+        if nick is not None:
+            self.nicks[nick] += 1
+        if channel is not None:
+            self.channels[channel] += 1
+
+    def admit(self, nick, channel, start, destination=None):
+        # Calls start now, or once there's room. Returns False if rejected
+        with self.lock:
+            if self.allowed(nick, channel):
+                self.take(nick, channel)
+                self.counts["admitted"] += 1
+                waiting = False
+            elif len(self.queue) < self.waiting:
+                self.queue.append((nick, channel, start))
+                self.counts["queued"] += 1
+                waiting = True
+            else:
+                self.counts["rejected"] += 1
+                return False
+            self.rejections.discard(destination)
+        if not waiting:
+            start()
+        return True
+
+    def release(self, nick, channel):
+        # Called when a command finishes, and starts any that can now run
+        ready = []
+        with self.lock:
+            self.running -= 1
+            if nick is not None:
+                self.nicks[nick] -= 1
+                if not self.nicks[nick]:
+                    del self.nicks[nick]
+            if channel is not None:
+                self.channels[channel] -= 1
+                if not self.channels[channel]:
+                    del self.channels[channel]
+
+            for item in list(self.queue):
+                if self.allowed(item[0], item[1]):
+                    self.queue.remove(item)
+                    self.take(item[0], item[1])
+                    self.counts["admitted"] += 1
+                    ready.append(item[2])
+        for start in ready:
+            start()
+
+    def notify(self, destination):
+        # Whether to tell destination about a rejection, once per flood
+        with self.lock:
+            if destination in self.rejections:
+                return False
+            self.rejections.add(destination)
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "running": self.running,
+                "waiting": len(self.queue),
+                "admitted": self.counts["admitted"],
+                "queued": self.counts["queued"],
+                "rejected": self.counts["rejected"],
+                "nicks": dict(self.nicks),
+                "channels": dict(self.channels)
+            }
+
+class Flights(object):
+    # Commands which are running, so that the same command with the same
+    # input can wait for the result instead of running again
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.counts = collections.Counter()
+
+    def join(self, key, destination):
+        # Returns True if key is in flight, and destination now waits for it
+        with self.lock:
+            destinations = self.flights.get(key)
+            if destinations is None:
+                self.flights[key] = [destination]
+                self.counts["started"] += 1
+                return False
+            if destination not in destinations:
+                destinations.append(destination)
+            self.counts["coalesced"] += 1
+            return True
+
+    def finish(self, key):
+        # Returns the destinations which were waiting for key
+        with self.lock:
+            return self.flights.pop(key, [])
+
+    def stats(self):
+        with self.lock:
+            return {
+                "flying": len(self.flights),
+                "started": self.counts["started"],
+                "coalesced": self.counts["coalesced"]
+            }
+
+def limit_option(section, option, default):
+    value = section.get(option, default)
+    if value in {None, "", "none"}:
+        return None
+    return int(value)
+
 class Saxo(object):
-    def __init__(self, base, opt):
+    def __init__(self, base, opt, network=None, master=None):
+        # With more than one network, opt is the view for this network, and
+        # master is the whole config file. See network_options
         self.base = base
         self.opt = opt
+        self.network = network
+        self.master = opt if (master is None) else master
         self.events = {}
+        # Migrations by (name, version), which plugins/schema.py applies
+        self.migrations = {}
         self.address = None
         self.limit = None
         self.discotimer = None
@@ -277,6 +797,17 @@ class Saxo(object):
         self.sending_thread = None
         self.reconnecting = False
         self.links = {}
+        self.pool = None
+        self.resident = None
+        self.admission = None
+        self.flights = Flights()
+        self.cache = None
+        self.commands = CommandIndex(base)
+        self.scripts = Scripts(self.commands)
+
+        # Open connections to the database, which plugins also borrow from
+        database_filename = os.path.join(base, "database.sqlite3")
+        self.connections = sqlite.pool(database_filename)
 
         self.environment_cache = os.environ.copy()
         self.environment_cache["PYTHONPATH"] = saxo_path
@@ -286,6 +817,17 @@ class Saxo(object):
         self.environment_cache["SAXO_COMMANDS"] = \
             os.path.join(base, "commands")
         self.environment_cache["SAXO_VERSION"] = saxo_version
+        # So that commands use the [database] settings too
+        self.environment_cache["SAXO_DATABASE"] = sqlite.options()
+
+        # Each network has its own queues, fed from the shared incoming queue
+        if network is None:
+            self.incoming = incoming
+            self.outgoing = outgoing
+        else:
+            self.incoming = common.Instructions()
+            self.outgoing = Outgoing()
+            self.environment_cache["SAXO_NETWORK"] = network
 
         self.config_cache = {}
         client_options = {
@@ -294,7 +836,12 @@ class Saxo(object):
             "owner", # Full address of the owner
             "prefix", # Command prefix
             "flood", # Whether or not to flood
-            "private" # Whether to respond in private
+            "private", # Whether to respond in private
+            "core", # Either threads, the default, or asyncio
+            "scheduler", # Either heap, the default, or wheel
+            "workers", # Number of warm python command workers
+            "resident", # Commands to run inside the saxo process
+            "results" # Entries and bytes of command results to keep
         }
 
         for option in opt["client"]:
@@ -308,18 +855,83 @@ class Saxo(object):
                 continue
             self.config_cache[section] = dict(opt[section])
 
+        # Commands whose output lines are sent as they arrive
+        # The option is the maximum number of lines, and optionally bytes
+        self.streams = {}
+        if "stream" in opt:
+            for cmd, limits in opt["stream"].items():
+                limits = [int(n) for n in limits.split()]
+                if len(limits) == 1:
+                    limits.append(limits[0] * 512)
+                self.streams[cmd] = tuple(limits[:2])
+
+        # Seconds to keep the results of a command for, and optionally the
+        # variables that they depend on. This overrides any script header
+        self.cached = {}
+        if "cache" in opt:
+            for cmd, option in opt["cache"].items():
+                self.cached[cmd] = cache_option(option)
+
+        # Days to keep the rows of tables for, by their unixtime column
+        self.retention = {"saxo_seen": 365, "saxo_to": 365}
+        if "retention" in opt:
+            for table, days in opt["retention"].items():
+                self.retention[table] = float(days)
+        self.maintaining = threading.Lock()
+        self.maintenance = None
+
     def run(self):
+        self.setup_commands()
         self.load()
         self.connect()
         self.handle()
 
+    def setup_commands(self):
+        workers_option = self.opt["client"].get("workers", "0")
+        if int(workers_option) > 0:
+            self.pool = workers.Pool(int(workers_option),
+                self.environment_cache)
+
+        resident_option = self.opt["client"].get("resident", "")
+        if resident_option.split():
+            self.resident = workers.Resident(resident_option.split())
+
+        sizes = self.opt["client"].get("results", "1024").split()
+        entries = int(sizes[0])
+        size = int(sizes[1]) if (len(sizes) > 1) else 1048576
+        database = None
+        if "persistent" in sizes[2:]:
+            database = os.path.join(self.base, "database.sqlite3")
+        self.cache = cache.Cache(entries, size, database)
+
+        limits = self.opt["limits"] if ("limits" in self.opt) else {}
+        self.admission = Admission(
+            total=limit_option(limits, "total", "16"),
+            nick=limit_option(limits, "nick", "4"),
+            channel=limit_option(limits, "channel", "8"),
+            waiting=limit_option(limits, "waiting", "64") or 0)
+        self.overflow = limits.get("overflow",
+            "Sorry, too many commands are running. Try again soon")
+
     def load(self):
         # Update symlinks
         common.populate(saxo_path, self.base)
+        self.commands.build()
 
         # Load events
         first = not self.events
+
+        # Commands run inside saxo are loaded again on demand
+        if self.resident is not None:
+            self.resident.clear()
+        # And workers import saxo's modules again
+        if (self.pool is not None) and (not first):
+            self.pool.restart()
+        if not first:
+            # Plugins are about to be reloaded, losing what they hold
+            self.flush()
         self.events.clear()
+        self.migrations.clear()
 
         def module_exists(name):
             try: imp.find_module(name)
@@ -378,6 +990,12 @@ class Saxo(object):
                     obj.saxo_name = module.__name__ + "." + obj.__name__
                     setups[obj.saxo_name] = obj
 
+                elif hasattr(obj, "saxo_migration"):
+                    if obj.saxo_migration in self.migrations:
+                        debug("Warning: Duplicate migration:",
+                            obj.saxo_migration)
+                    self.migrations[obj.saxo_migration] = obj
+
             # debug("Loaded module:", name)
 
         debug("%s setup functions" % len(setups))
@@ -387,8 +1005,7 @@ class Saxo(object):
             deps = ["plugins." + dep for dep in setup.saxo_deps]
             graph[setup.saxo_name] = deps
 
-        database_filename = os.path.join(self.base, "database.sqlite3")
-        with sqlite.Database(database_filename) as self.db:
+        with self.database() as self.db:
             for name in common.tsort(graph):
                 debug(name)
                 if name in setups:
@@ -396,6 +1013,11 @@ class Saxo(object):
                 else:
                     debug("Warning: Missing dependency:", name)
 
+        # Setups may have changed saxo_periodic and saxo_schedule
+        scheduler.incoming.put(("load", ()))
+        # And made saxo_cache, from which kept results are read once
+        if first:
+            self.cache.load()
         sys.path[:1] = []
 
     def connect(self):
@@ -406,12 +1028,22 @@ class Saxo(object):
         self.first = True
         # TODO: Reset other state? e.g. self.address
 
-        receiving = (socket_receive, self.sock)
+        receiving = (socket_receive, self.sock, self.incoming)
         self.receiving_thread = common.thread(*receiving)
 
-        sending = (socket_send, self.sock, "flood" in self.opt["client"])
+        self.flood_limit()
+        sending = (socket_send, self.sock, self.incoming, self.outgoing)
         self.sending_thread = common.thread(*sending)
 
+    def flood_limit(self):
+        if "flood" in self.opt["client"]:
+            self.outgoing.limit(None, 1)
+        else:
+            # Messages per second, and how many can be sent at once
+            rate = float(self.opt["server"].get("rate", "1"))
+            burst = int(self.opt["server"].get("burst", "4"))
+            self.outgoing.limit(rate, burst)
+
     def connect_sock(self):
         host = self.opt["server"]["host"]
         port = int(self.opt["server"]["port"])
@@ -444,6 +1076,9 @@ class Saxo(object):
         self.cancel_discotimer()
 
     def socket_threads_active(self):
+        # Neither has been started before the first connection
+        if self.receiving_thread is None:
+            return False
         receiving = self.receiving_thread.is_alive()
         sending = self.sending_thread.is_alive()
         debug("RECV, SEND:", receiving, sending)
@@ -464,25 +1099,27 @@ class Saxo(object):
 
     def handle(self):
         while True:
-            instruction_args = incoming.get()
-            instruction = instruction_args[0]
-            args = tuple(instruction_args[1:])
+            self.instruct(self.incoming.get())
 
-            if instruction not in {"instances", "remote"}:
-                debug("handle:", instruction, args)
+    def instruct(self, instruction_args):
+        instruction = instruction_args[0]
+        args = tuple(instruction_args[1:])
 
-            if not isinstance(instruction, str):
-                continue
+        if instruction not in {"instances", "remote"}:
+            debug("handle:", instruction, args)
 
-            method_name = "instruction_" + instruction
-            if hasattr(self, method_name):
-                method = getattr(self, method_name)
-                try: method(*args)
-                except Exception as err:
-                    debug("handle error:", err)
-                    # raise err # - for debug
-            else:
-                debug("Unknown instruction:", instruction)
+        if not isinstance(instruction, str):
+            return
+
+        method_name = "instruction_" + instruction
+        if hasattr(self, method_name):
+            method = getattr(self, method_name)
+            try: method(*args)
+            except Exception as err:
+                debug("handle error:", err)
+                # raise err # - for debug
+        else:
+            debug("Unknown instruction:", instruction)
 
     def instruction_address(self, address):
         self.address = address
@@ -515,7 +1152,7 @@ class Saxo(object):
         except SaxoConnectionError as err:
             # Retry, with 1sec more delay, up to a maximum of 30sec delay
             def connect():
-                incoming.put(("connect", min(30, delay + 1)))
+                self.incoming.put(("connect", min(30, delay + 1)))
             t = threading.Timer(delay, connect)
             t.start()
 
@@ -531,29 +1168,52 @@ class Saxo(object):
     def instruction_disco_receiving(self):
         self.receiving = False
         debug("Sending disconnected event to scheduler")
-        scheduler.incoming.put(("disconnected", ()))
+        scheduler.incoming.put(("disconnected", self.network))
         if self.sending:
-            outgoing.put(None)
+            self.outgoing.put(None)
         else:
-            incoming.put(("connect",))
+            self.incoming.put(("connect",))
 
     def instruction_disco_sending(self):
         self.sending = False
         if self.receiving:
             self.disconnect()
         else:
-            incoming.put(("connect",))
+            self.incoming.put(("connect",))
+
+    def instruction_event(self, name, *args):
+        # Lets commands tell plugins about something, as the :name event
+        if (":" + name) in self.events:
+            msg = Message(self, b"NOOP")
+            msg.parameters = list(args)
+            for function in self.events[":" + name]:
+                try: function(msg)
+                except Exception as err:
+                    debug("Error:", function.__name__ + ":", err)
+
+    def instruction_flush(self, reply=None):
+        self.flush()
+        if reply is not None:
+            reply(True)
+
+    def instruction_maintain(self, reply=None):
+        if not self.maintaining.acquire(blocking=False):
+            debug("Maintenance is already running")
+            if reply is not None:
+                reply(None)
+            return
+        common.thread(self.maintain, reply)
 
     def instruction_instances(self):
         our_pid = os.getpid()
-        database_filename = os.path.join(self.base, "database.sqlite3")
-        with sqlite.Database(database_filename) as db:
+        with self.database() as db:
             pids = [row[0] for row in db["saxo_instances"]]
         if len(pids) == 1:
             if pids[0] == our_pid:
                 return
 
         debug("Found another saxo instance! %s" % pids)
+        self.cleanup()
         self.send("QUIT", "Another saxo instance was detected")
         self.disconnect()
         exit(0)
@@ -598,13 +1258,27 @@ class Saxo(object):
         self.update_config("client", "channels", channels)
         self.send("PART", channel)
 
-    def instruction_periodic(self, name, period, cmd, arg, sender=None):
-        database_filename = os.path.join(self.base, "database.sqlite3")
-        with sqlite.Database(database_filename) as db:
-            p = (name, period, int(time.time()), b"scheduled",
-                 common.b64pickle((cmd, arg, sender)))
+    def instruction_periodic(self, name, period, cmd, arg, sender=None,
+            missed=1, jitter=0):
+        # period is in seconds, or a cron expression such as "0 9 * * 1-5"
+        # missed is how many runs to catch up: 0 for none, 1 for one run
+        # jitter is the most seconds to add to each run, at random
+        expression = None
+        if isinstance(period, str):
+            expression, period = period, None
+        now = int(time.time())
+        due = scheduler.next_run(period, expression, now, jitter)
+        if due is None:
+            raise ValueError("Never due: %r" % expression)
+
+        instruction = self.qualify("scheduled").encode("ascii")
+        with self.database() as db:
+            p = (name, period, now, instruction,
+                 common.b64pickle((cmd, arg, sender)), missed,
+                 expression, jitter, due)
             # TODO: This fails silently if there's a type error?
             db["saxo_periodic"].replace(p)
+        scheduler.incoming.put(("periodic.add", p))
 
     def instruction_ping(self):
         now = time.time()
@@ -617,7 +1291,7 @@ class Saxo(object):
         self.send("PING", self.opt["client"]["nick"])
 
         def reconnect():
-            incoming.put(("reconnect",))
+            self.incoming.put(("reconnect",))
 
         # Make sure the timer is shorter than the pingloop!
         # Default pingloop period is 180
@@ -631,6 +1305,7 @@ class Saxo(object):
         # Never call this from a thread, otherwise this can give an OSError
         # TODO: Get the sender to pick this up and disconnect from there?
         # Could be a problem if the sender has broken
+        self.cleanup()
         self.send("QUIT")
         self.disconnect()
         exit(0)
@@ -638,7 +1313,7 @@ class Saxo(object):
     def instruction_receiving(self):
         self.receiving = time.time()
 
-        scheduler.incoming.put(("connected", ()))
+        scheduler.incoming.put(("connected", self.network))
         def start_scheduler():
             scheduler.incoming.put(("start", ()))
         start = threading.Timer(3, start_scheduler)
@@ -646,7 +1321,7 @@ class Saxo(object):
 
         # TODO: Check that we really are connected
         # TODO: Unit test for :connected event
-        incoming.put(("connected",))
+        self.incoming.put(("connected",))
 
     def instruction_reconnect(self):
         # disco_* will automatically reconnect
@@ -655,7 +1330,7 @@ class Saxo(object):
             self.disconnect()
         elif self.sending or self.sending_thread.is_alive():
             # Signal the sending thread to quit
-            outgoing.put(None)
+            self.outgoing.put(None)
         else:
             debug("Reconnect requested during reconnect")
 
@@ -695,8 +1370,11 @@ class Saxo(object):
         run(msg.command, msg)
         run("*", msg)
 
+    def instruction_stats(self, reply):
+        reply(self.stats())
+
     def instruction_schedule(self, unixtime, command, args):
-        command = command.encode("ascii")
+        command = self.qualify(command).encode("ascii")
         args = common.b64pickle(args)
         # TODO: Why not just add it to the database ourselves?
         scheduler.incoming.put(("schedule.add", (unixtime, command, args)))
@@ -710,17 +1388,76 @@ class Saxo(object):
     def instruction_sending(self):
         self.sending = True
 
+    def flush(self):
+        # Plugins save what they keep in memory on the :flush event
+        if ":flush" in self.events:
+            msg = Message(self, b"NOOP")
+            for function in self.events[":flush"]:
+                try: function(msg)
+                except Exception as err:
+                    debug("Error:", function.__name__ + ":", err)
+
+    def cleanup(self):
+        # Before exiting
+        self.flush()
+        if self.pool is not None:
+            self.pool.stop()
+
+    def database(self):
+        # Use as "with self.database() as db", which borrows a connection
+        return self.connections.borrow()
+
+    def stats(self):
+        return {
+            "commands": self.admission.stats(),
+            "flights": self.flights.stats(),
+            "cache": self.cache.stats(),
+            "database": dict(self.connections.stats(), **sqlite.stats()),
+            "maintenance": self.maintenance,
+            "scheduler": scheduler.stats()
+        }
+
+    def maintain(self, reply=None):
+        # Deletes old rows, and then compacts the database
+        # Runs in its own thread, and saves a report of what it did
+        try:
+            started = time.time()
+            removed = {}
+            with self.database() as db:
+                for table, days in sorted(self.retention.items()):
+                    if (days <= 0) or (table not in db):
+                        continue
+                    if "unixtime" not in db[table].fields():
+                        debug("Warning: Can't prune %s, no unixtime" % table)
+                        continue
+                    before = int(started - (days * 86400))
+                    removed[table] = db[table].prune("unixtime < ?", (before,))
+
+                # Persistent results of commands which have expired
+                if "saxo_cache" in db:
+                    removed["saxo_cache"] = db["saxo_cache"].prune(
+                        "expires <= ?", (started,))
+
+                reclaimed = sqlite.compact(db)
+
+            self.maintenance = {
+                "unixtime": int(started),
+                "duration": time.time() - started,
+                "removed": removed,
+                "reclaimed": reclaimed
+            }
+            debug("Maintenance:", self.maintenance)
+            if reply is not None:
+                reply(self.maintenance)
+        finally:
+            self.maintaining.release()
+
     def command(self, msg):
         cmd, arg = msg.cmd, msg.arg
-        path = command_path(self.base, cmd)
+        path = self.commands.path(cmd)
         if path is None:
             return
 
-        def command_process(env, cmd, path, arg):
-            outs = process(env, cmd, path, arg)
-            if outs:
-                self.send("PRIVMSG", msg.sender, outs)
-
         env = self.environment_cache.copy()
         env["SAXO_NICK"] = msg.nick
         env["SAXO_SENDER"] = msg.sender
@@ -728,27 +1465,159 @@ class Saxo(object):
             env["SAXO_URL"] = self.links[msg.sender]
         if msg.authorised():
             env["SAXO_AUTHORISED"] = "1"
-        common.thread(command_process, env, cmd, path, arg)
+        self.dispatch(env, cmd, path, arg, msg.sender)
 
     def scheduled_command(self, cmd, arg, sender=None):
-        path = command_path(self.base, cmd)
+        path = self.commands.path(cmd)
         if path is None:
             return
 
-        def command_process(env, cmd, path, arg):
-            outs = process(env, cmd, path, arg)
-            if outs and (sender is not None):
-                self.send("PRIVMSG", sender, outs)
-
         env = self.environment_cache.copy()
         env["SAXO_SCHEDULED"] = "1"
-        common.thread(command_process, env, cmd, path, arg)
+        self.dispatch(env, cmd, path, arg, sender)
+
+    def dispatch(self, env, cmd, path, arg, destination):
+        store = None
+        caching = self.caching(env, cmd, path, arg, destination)
+        if caching is not None:
+            ttl, cache_key = caching
+            text = self.cache.get(cache_key)
+            if text is not None:
+                if text:
+                    self.send("PRIVMSG", destination, text)
+                return
+
+            def store(text):
+                self.cache.put(cache_key, text, ttl)
+
+        key = self.flight(env, cmd, path, arg, destination)
+        if (key is not None) and self.flights.join(key, destination):
+            return
+
+        nick, channel = self.admission_keys(env, destination)
+        def start():
+            self.start(env, cmd, path, arg, destination, key, store)
+
+        if self.admission.admit(nick, channel, start, destination):
+            return
+        # Anything waiting for the same command is told that it didn't run
+        destinations = [destination]
+        if key is not None:
+            destinations = self.flights.finish(key)
+        if not self.overflow:
+            return
+        for destination in destinations:
+            if destination is None:
+                continue
+            if self.admission.notify(destination):
+                self.send("PRIVMSG", destination, self.overflow)
+
+    def admission_keys(self, env, destination):
+        # The nick and channel that a command counts against
+        nick = env.get("SAXO_NICK")
+        channel = None
+        if (destination is not None) and destination.startswith("#"):
+            channel = destination
+        if self.network is not None:
+            if nick is not None:
+                nick = nick + "@" + self.network
+            if channel is not None:
+                channel = channel + "@" + self.network
+        return nick, channel
+
+    def flight(self, env, cmd, path, arg, destination):
+        # What makes this command the same as another, or None if it can't
+        # share its result. Scheduled commands and streams are never shared
+        if (destination is None) or ("SAXO_SCHEDULED" in env):
+            return None
+        if cmd in self.streams:
+            return None
+
+        variables = self.scripts.variables(path)
+        return (self.network, path, arg, values(env, variables))
+
+    def caching(self, env, cmd, path, arg, destination):
+        # How long to cache the result of this command, and its cache key
+        if (destination is None) or ("SAXO_SCHEDULED" in env):
+            return None
+        if cmd in self.streams:
+            return None
+
+        if cmd in self.cached:
+            ttl, variables = self.cached[cmd]
+        else:
+            header = self.scripts.cache(path)
+            if header is None:
+                return None
+            ttl, variables = header
+
+        if ttl <= 0:
+            return None
+        if variables is None:
+            variables = self.scripts.variables(path)
+        return ttl, (cmd, arg, values(env, variables))
+
+    def start(self, env, cmd, path, arg, destination, key=None, store=None):
+        job = (env, cmd, path, arg, destination, key, store)
+        common.thread(self.execute, *job)
+
+    def finished(self, env, destination, key, outs):
+        # Sends the output of a command to each destination waiting for it
+        self.admission.release(*self.admission_keys(env, destination))
+        destinations = [destination]
+        if key is not None:
+            destinations = self.flights.finish(key)
+
+        if outs:
+            for destination in destinations:
+                if destination is not None:
+                    self.send("PRIVMSG", destination, outs)
+
+    def stream(self, cmd, destination):
+        # Arguments for streaming the output of cmd, or None
+        if (destination is None) or (cmd not in self.streams):
+            return None
+
+        def output(text):
+            self.send("PRIVMSG", destination, text)
+        return self.streams[cmd] + (output,)
+
+    # threaded
+    def execute(self, env, cmd, path, arg, destination, key=None, store=None):
+        outs = None
+        try:
+            stream = self.stream(cmd, destination)
+            outs = process(env, cmd, path, arg, pool=self.pool,
+                resident=self.resident, stream=stream, store=store)
+        finally:
+            self.finished(env, destination, key, outs)
+
+    def qualify(self, instruction):
+        # Make instruction go to this network when it comes back to saxo
+        if (self.network is None) or ("@" in instruction):
+            return instruction
+        return instruction + "@" + self.network
+
+    def config_section(self, section):
+        # The section of the config file that a section of self.opt is in
+        if self.network is None:
+            return section
+        if section == "client":
+            return "client " + self.network
+        named = section + " " + self.network
+        if (section == "server") and (named in self.master):
+            return named
+        return section
 
     def update_config(self, section, option, value):
         self.opt[section][option] = value
+        master_section = self.config_section(section)
+        if master_section not in self.master:
+            self.master[master_section] = {}
+        self.master[master_section][option] = value
         config = os.path.join(self.base, "config")
         with open(config, "w", encoding="utf-8") as f:
-            self.opt.write(f)
+            self.master.write(f)
         if section == "client":
             self.config_cache[option] = value
         else:
@@ -765,14 +1634,32 @@ class Saxo(object):
             if (args[0] == "PRIVMSG") and args[1].startswith("#"):
                 search = regex_link.search(args[2])
                 if search:
-                    incoming.put(("link", args[1], search.group(1)))
+                    self.incoming.put(("link", args[1], search.group(1)))
 
         # Set a very conservative limit if we don't know the real limit
         limit = self.limit or 360
         while len(text.encode("utf-8", "replace")) > limit:
             text = text[:-1]
         octets = text.encode("utf-8", "replace")
-        outgoing.put(octets + b"\r\n")
+        self.outgoing.put(octets + b"\r\n")
+
+def parse_instruction(octets, reply=None):
+    text = octets.decode("ascii", "replace")
+    text = text.strip("\n")
+
+    # Queries start with "?", and get reply as their first argument
+    query = text.startswith("?")
+    if query:
+        text = text[1:]
+
+    if " " in text:
+        instruction, data = text.split(" ", 1)
+        args = common.b64unpickle(data)
+    else:
+        instruction, args = text, tuple()
+    if query:
+        args = (reply,) + args
+    return (instruction,) + args
 
 def serve(sockname, incoming):
     if os.path.exists(sockname):
@@ -786,19 +1673,15 @@ def serve(sockname, incoming):
         while True:
             connection, client = sock.accept()
             def handle(connection, client):
+                def reply(value):
+                    octets = common.b64pickle(value) + b"\n"
+                    try: connection.sendall(octets)
+                    except OSError:
+                        ...
+
                 try:
                     for octets in connection.makefile("rb"):
-                        try:
-                            text = octets.decode("ascii", "replace")
-                            text = text.strip("\n")
-
-                            if " " in text:
-                                instruction, data = text.split(" ", 1)
-                                args = common.b64unpickle(data)
-                            else:
-                                instruction, args = text, tuple()
-
-                            incoming.put((instruction,) + args)
+                        try: incoming.put(parse_instruction(octets, reply))
                         except Exception as err:
                             debug("ERROR!", err.__class__.__name__, err)
                 finally:
@@ -806,6 +1689,101 @@ def serve(sockname, incoming):
             common.thread(handle, connection, client)
     common.thread(listen, sock)
 
+def network_names(opt):
+    # Networks are configured in [server NAME] sections. When there are
+    # any, a plain [server] section is the network called "main"
+    names = []
+    for section in opt.sections():
+        if section.startswith("server "):
+            names.append(section.split(" ", 1)[1])
+    if names and ("server" in opt):
+        names.insert(0, "main")
+    return names
+
+def network_options(opt, name):
+    # The options for one network, as if it were the only one configured
+    # [server NAME] becomes [server], and [client NAME] overrides [client]
+    view = configparser.ConfigParser(interpolation=None)
+    for section in opt.sections():
+        if " " not in section:
+            view[section] = opt[section]
+
+    if ("server " + name) in opt:
+        view["server"] = opt["server " + name]
+    client = dict(opt["client"]) if ("client" in opt) else {}
+    if ("client " + name) in opt:
+        client.update(opt["client " + name])
+    view["client"] = client
+    return view
+
+class Networks(object):
+    # Several Saxo instances in one process, one for each network
+    # They share the command runners, plugins, scheduler, and database
+    # Instructions can be sent to a network with "instruction@network"
+    # Otherwise they go to the first network, apart from ping, which goes
+    # to all of them, and quit, which quits all of them
+    def __init__(self, saxos):
+        self.saxos = collections.OrderedDict()
+        for saxo in saxos:
+            self.saxos[saxo.network] = saxo
+        self.primary = saxos[0]
+
+    def setup(self):
+        primary = self.primary
+        primary.setup_commands()
+        primary.load()
+        for saxo in self.saxos.values():
+            saxo.events = primary.events
+            saxo.migrations = primary.migrations
+            saxo.commands = primary.commands
+            saxo.pool = primary.pool
+            saxo.resident = primary.resident
+            saxo.admission = primary.admission
+            saxo.flights = primary.flights
+            saxo.cache = primary.cache
+            saxo.scripts = primary.scripts
+            saxo.overflow = primary.overflow
+
+    def run(self):
+        self.setup()
+        # Connecting is an instruction, so that failures are retried
+        for saxo in self.saxos.values():
+            saxo.incoming.put(("connect",))
+            common.thread(saxo.handle)
+
+        while True:
+            self.route(incoming.get())
+
+    def route(self, instruction_args):
+        instruction = instruction_args[0]
+        args = tuple(instruction_args[1:])
+        if not isinstance(instruction, str):
+            return
+
+        if "@" in instruction:
+            instruction, name = instruction.split("@", 1)
+            if name not in self.saxos:
+                debug("Unknown network:", name)
+                return
+            saxos = [self.saxos[name]]
+        elif instruction == "ping":
+            saxos = list(self.saxos.values())
+        else:
+            saxos = [self.primary]
+
+        if instruction == "quit":
+            self.quit()
+
+        for saxo in saxos:
+            saxo.incoming.put((instruction,) + args)
+
+    def quit(self):
+        self.primary.cleanup()
+        for saxo in self.saxos.values():
+            saxo.send("QUIT")
+            saxo.disconnect()
+        exit(0)
+
 E_NO_CONFIG = """
 Are you sure this is a saxo configuration directory? If you need to make a new
 configuration directory, use the `saxo create` command.
@@ -826,9 +1804,10 @@ def start(base):
     # TODO: Defaulting?
     # TODO: Warn if the config file is widely readable?
 
+    if "database" in opt:
+        sqlite.configure(opt["database"])
+
     sockname =  os.path.join(base, "client.sock")
-    serve(sockname, incoming)
-    os.chmod(sockname, 0o600)
 
     # NOTE: If using os._exit, this doesn't work
     def remove_sock(sockname):
@@ -836,8 +1815,266 @@ def start(base):
             os.remove(sockname)
     atexit.register(remove_sock, sockname)
 
-    sched = scheduler.Scheduler(incoming)
+    names = network_names(opt)
+    if opt["client"].get("core", "threads") == "asyncio":
+        # Save PEP 3122!
+        if "." in __name__:
+            from . import eventloop
+        else:
+            import eventloop
+
+        eventloop.start(base, opt, sockname, names)
+        return
+
+    serve(sockname, incoming)
+    os.chmod(sockname, 0o600)
+
+    sched = scheduler.Scheduler(incoming, opt["client"].get("scheduler"))
     common.thread(sched.start, base)
 
-    saxo = Saxo(base, opt)
-    saxo.run()
+    if names:
+        saxos = []
+        for name in names:
+            view = network_options(opt, name)
+            saxos.append(Saxo(base, view, network=name, master=opt))
+        networks = Networks(saxos)
+        common.exit_cleanly(networks.primary.cleanup)
+        networks.run()
+    else:
+        saxo = Saxo(base, opt)
+        common.exit_cleanly(saxo.cleanup)
+        saxo.run()
+
+def test():
+    # Commands over a limit wait, and are rejected when the queue is full
+    started = []
+    admission = Admission(total=1, waiting=1)
+    assert admission.admit("a", "#a", lambda: started.append("a"))
+    assert admission.admit("b", "#b", lambda: started.append("b"))
+    assert not admission.admit("c", "#c", lambda: started.append("c"), "#c")
+    assert started == ["a"]
+    # The rejected destination is told once, until something is admitted
+    assert admission.notify("#c")
+    assert not admission.notify("#c")
+    admission.release("a", "#a")
+    assert started == ["a", "b"]
+    assert admission.admit("c", "#c", lambda: started.append("c"), "#c")
+    assert admission.notify("#c")
+    stats = admission.stats()
+    assert (stats["running"], stats["waiting"]) == (1, 1)
+    assert (stats["admitted"], stats["rejected"]) == (2, 1)
+
+    # The nick and channel limits apply to each nick and channel
+    admission = Admission(nick=1, channel=2)
+    assert admission.admit("a", "#a", lambda: started.append("a1"))
+    assert not admission.admit("a", "#a", lambda: started.append("a2"))
+    assert admission.admit("b", "#a", lambda: started.append("b1"))
+    assert not admission.admit("c", "#a", lambda: started.append("c1"))
+    assert admission.admit("c", None, lambda: started.append("c2"))
+    assert admission.stats()["nicks"] == {"a": 1, "b": 1, "c": 1}
+    admission.release("a", "#a")
+    assert admission.stats()["channels"] == {"#a": 1}
+
+    # Protocol messages go first, then destinations take turns
+    queued = Outgoing()
+    for octets in (b"PRIVMSG #a :1\r\n", b"PRIVMSG #a :2\r\n",
+                   b"PRIVMSG #B :3\r\n", b"PONG :x\r\n",
+                   b"PRIVMSG #b :4\r\n"):
+        queued.put(octets)
+    order = [queued.get().split(b" :")[1] for n in range(5)]
+    assert order == [b"x\r\n", b"1\r\n", b"3\r\n", b"2\r\n", b"4\r\n"]
+    assert queued.take() == (False, None)
+    # Within the token bucket's burst and rate
+    queued.limit(10, 2)
+    for n in range(3):
+        queued.put(b"PRIVMSG #a :%d\r\n" % n)
+    assert queued.take()[0] and queued.take()[0]
+    ready, delay = queued.take()
+    assert (not ready) and (0 < delay <= 0.1)
+    time.sleep(delay)
+    assert queued.take() == (True, b"PRIVMSG #a :2\r\n")
+
+    # Streamed lines are sent as they're completed, up to the limits
+    lines = []
+    limited = Lines(2, 100, lines.append)
+    limited.feed(b"one\ntw")
+    assert lines == ["one"]
+    limited.feed(b"o\r\n\nthree\n")
+    assert lines == ["one", "two"]
+    assert limited.wanted() == 0
+    limited.finish()
+    assert (lines, limited.sent) == (["one", "two"], 2)
+    # Or up to the bytes limit, with the rest of the last line sent after
+    lines = []
+    limited = Lines(5, 8, lines.append)
+    assert limited.wanted() == 8
+    limited.feed(b"abc\nde")
+    assert limited.wanted() == 2
+    limited.feed(b"fg")
+    assert limited.wanted() == 0
+    limited.finish()
+    assert lines == ["abc", "defg"]
+
+    # Destinations wait for a command which is already running
+    flights = Flights()
+    assert not flights.join("key", "#a")
+    assert flights.join("key", "#b")
+    assert flights.join("key", "#a")
+    assert flights.finish("key") == ["#a", "#b"]
+    assert flights.finish("key") == []
+    assert not flights.join("key", "#c")
+
+    import shutil
+    import tempfile
+
+    base = tempfile.mkdtemp()
+    os.mkdir(os.path.join(base, "commands"))
+    runs = os.path.join(base, "runs")
+    def script(name, text):
+        path = os.path.join(base, "commands", name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\n" + text + "\n")
+        os.chmod(path, 0o755)
+        return path
+    def count(name):
+        with open(runs) as f:
+            return f.read().split().count(name)
+
+    opt = configparser.ConfigParser(interpolation=None)
+    opt.read_dict({"client": {"nick": "saxo", "prefix": "."}})
+    saxo = Saxo(base, opt, network="test")
+    saxo.setup_commands()
+    sent = []
+    def send(*args):
+        sent.append(args)
+    saxo.send = send
+    def dispatch(cmd, arg, destination):
+        env = saxo.environment_cache.copy()
+        env["SAXO_NICK"] = "nick"
+        env["SAXO_SENDER"] = destination
+        path = saxo.commands.path(cmd)
+        saxo.dispatch(env, cmd, path, arg, destination)
+    def received(number):
+        for attempt in range(100):
+            if len(sent) >= number:
+                return sorted(sent)
+            time.sleep(0.1)
+        raise AssertionError("Expected %s messages, got %s" % (number, sent))
+    def eventually(check):
+        for attempt in range(100):
+            if check():
+                return
+            time.sleep(0.1)
+        raise AssertionError(check)
+
+    try:
+        # The command index notices commands being added and removed
+        index = CommandIndex(base, interval=0)
+        assert index.path("new") is None
+        path = script("new", "echo new")
+        eventually(lambda: index.path("new") == path)
+        os.remove(path)
+        eventually(lambda: index.path("new") is None)
+        # Names with dots, and empty files, aren't commands
+        script("new.sh", "echo new")
+        open(os.path.join(base, "commands", "empty"), "w").close()
+        script("other", "echo other")
+        eventually(lambda: index.path("other") is not None)
+        assert set(index.paths) == {"other"}
+
+        # A streamed command is stopped once it has sent enough lines
+        path = script("forever", "while true; do echo line; done")
+        lines = []
+        env = saxo.environment_cache.copy()
+        sent_lines, code = spawn_lines(env, path, "", 5, 3, 1000, lines.append)
+        assert (sent_lines, lines) == (3, ["line"] * 3)
+        assert streamed("forever", sent_lines, code) is None
+
+        # Two of the same command at once only run once
+        script("slow", "echo slow >> %s; sleep 0.5; echo $1" % runs)
+        dispatch("slow", "x", "#a")
+        dispatch("slow", "x", "#b")
+        assert received(2) == [("PRIVMSG", "#a", "x"), ("PRIVMSG", "#b", "x")]
+        assert count("slow") == 1
+        assert saxo.flights.stats()["coalesced"] == 1
+        # But not when the argument is different
+        del sent[:]
+        dispatch("slow", "y", "#a")
+        dispatch("slow", "z", "#b")
+        assert received(2) == [("PRIVMSG", "#a", "y"), ("PRIVMSG", "#b", "z")]
+        assert count("slow") == 3
+        assert saxo.flights.stats()["flying"] == 0
+
+        # A command that allows it is answered from the cache
+        del sent[:]
+        script("kept", "# cache: 60\necho kept >> %s; echo $1" % runs)
+        dispatch("kept", "x", "#a")
+        received(1)
+        dispatch("kept", "x", "#b")
+        assert received(2) == [("PRIVMSG", "#a", "x"), ("PRIVMSG", "#b", "x")]
+        assert count("kept") == 1
+
+        # But not with an error, even when the command printed something
+        del sent[:]
+        script("broken", "# cache: 60\necho broken >> %s; echo $1; exit 1"
+            % runs)
+        dispatch("broken", "x", "#a")
+        received(1)
+        dispatch("broken", "x", "#a")
+        assert received(2) == [("PRIVMSG", "#a", "x")] * 2
+        assert count("broken") == 2
+        assert saxo.cache.stats()["entries"] == 1
+
+        # Migrations bring tables made by older versions up to date
+        with sqlite.Database(os.path.join(base, "database.sqlite3")) as db:
+            db.execute("CREATE TABLE saxo_seen " +
+                "(nick TEXT PRIMARY KEY, unixtime INTEGER, channel TEXT)")
+            db.execute("INSERT INTO saxo_seen VALUES ('Alice[]', 1, '#a')")
+            db.execute("CREATE TABLE saxo_to (sender TEXT, recipient TEXT, " +
+                "unixtime INTEGER, channel TEXT, message TEXT)")
+            db.execute("INSERT INTO saxo_to " +
+                "VALUES ('x', 'Bob[]', 1, '#a', 'hi')")
+            db.commit()
+        saxo.load()
+        with saxo.database() as db:
+            versions = dict(db["saxo_schema"].select())
+            assert versions["saxo_seen"] == versions["saxo_to"] == 4
+            assert list(db.query("SELECT nick, folded FROM saxo_seen")) == \
+                [("Alice[]", "alice{}")]
+            assert list(db.query("SELECT folded FROM saxo_to")) == \
+                [("bob{}",)]
+            indexes = {row[0] for row in db.query("SELECT name " +
+                "FROM sqlite_master WHERE type = 'index'")}
+            assert {"saxo_to_folded", "saxo_to_unixtime"} <= indexes
+            assert "saxo_to_recipient" not in indexes
+        # And are only applied once
+        saxo.load()
+        with saxo.database() as db:
+            assert dict(db["saxo_schema"].select()) == versions
+            assert len(list(db["saxo_seen"])) == 1
+
+        # Messages are delivered once, when the recipient next speaks
+        def hear(octets):
+            msg = Message(saxo, octets)
+            for function in saxo.events[msg.command]:
+                function(msg)
+        del sent[:]
+        hear(b":carol!c@h PRIVMSG #a :hello")
+        assert sent == []
+        hear(b":BOB{}!b@h PRIVMSG #a :hello")
+        hear(b":BOB{}!b@h PRIVMSG #a :hello")
+        assert sent == [("PRIVMSG", "#a", "Bob[]: <x> hi")]
+        # The .to command adds to the table, and tells saxo with :to
+        with saxo.database() as db:
+            assert len(list(db["saxo_to"])) == 0
+            db["saxo_to"].insert(("x", "Carol", 2, "#a", "hey", "carol"))
+        hear(b":carol!c@h PRIVMSG #a :hello")
+        assert len(sent) == 1
+        saxo.instruction_event("to", "Carol")
+        hear(b":carol!c@h PRIVMSG #a :hello")
+        assert sent[1:] == [("PRIVMSG", "#a", "Carol: <x> hey")]
+    finally:
+        shutil.rmtree(base)
+
+if __name__ == "__main__":
+    test()
@@ -11,7 +11,7 @@ def dependencies(*deps):
     return decorator
 
 @saxo.setup
-@dependencies("schema.instances")
+@dependencies("schema.migrate")
 def populate(irc):
     # Remove any values from previous instances
     for row in irc.db["saxo_instances"]:
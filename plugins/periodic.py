@@ -10,22 +10,26 @@ def dependencies(*deps):
         return function
     return decorator
 
-def replace(irc, *args):
-    irc.db["saxo_periodic"].replace(args)
+def replace(irc, name, period, recent, command, args, missed, jitter=0):
+    # Without a cron expression, and the scheduler works out the next run
+    irc.db["saxo_periodic"].replace((name, period, recent, command, args,
+        missed, None, jitter, None))
 
 @saxo.setup
-@dependencies("schema.periodic")
+@dependencies("schema.migrate")
 def populate(irc):
     # Periodic tasks whose names start with "@" are temporary
     # This code deletes those tasks on initialisation
-    temporary = []
-    for row in irc.db["saxo_periodic"].rows():
-        if row[0].startswith("@"):
-            temporary.append(row)
-    for row in temporary:
-        del irc.db["saxo_periodic"][row]
+    irc.db["saxo_periodic"].delete(where="substr(name, 1, 1) = '@'")
 
+    # The last argument is how many missed runs to catch up, if any
     current = int(time.time())
     # TODO: Or "check_connection" instead of "ping"
-    replace(irc, "check connection", 180, current, b"ping", b"")
-    replace(irc, "check unique", 20, current, b"instances", b"")
+    replace(irc, "check connection", 180, current, b"ping", b"", 0)
+    replace(irc, "check unique", 20, current, b"instances", b"", 0)
+    # Plugins that keep things in memory, such as seen, save them on flush
+    replace(irc, "write buffers", 30, current, b"flush", b"", 1)
+    # Deleting old rows, and compacting the database, once a day
+    # Bots on the same machine shouldn't all do this at the same time
+    replace(irc, "maintain database", 86400, current, b"maintain", b"", 1,
+        jitter=3600)
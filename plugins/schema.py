@@ -3,36 +3,128 @@
 
 import saxo
 
+# Tables are made and changed by migrations, which plugins give with
+# @saxo.migration(name, version). Each is applied once, in its own
+# transaction, and saxo_schema keeps the version that each name has reached
+
+def dependencies(*deps):
+    def decorator(function):
+        function.saxo_deps = deps
+        return function
+    return decorator
+
+@saxo.setup
+def migrate(irc):
+    if "saxo_schema" not in irc.db:
+        irc.db["saxo_schema"].create(
+            ("name", "TEXT PRIMARY KEY"),
+            ("version", int))
+    versions = dict(irc.db["saxo_schema"].select())
+
+    irc.db.commit()
+    for (name, version) in sorted(irc.migrations):
+        if version <= versions.get(name, 0):
+            continue
+
+        irc.db.execute("BEGIN")
+        try:
+            irc.migrations[(name, version)](irc)
+            irc.db["saxo_schema"].replace((name, version), commit=False)
+            irc.db.commit()
+        except:
+            irc.db.connection.rollback()
+            raise
+        versions[name] = version
+
+# These were the setup functions before migrations, and plugins may still
+# depend on them
 @saxo.setup
+@dependencies("schema.migrate")
 def instances(irc):
-    if not "saxo_instances" in irc.db:
-        irc.db["saxo_instances"].create(
-            ("pid", int))
+    ...
 
 @saxo.setup
+@dependencies("schema.migrate")
 def periodic(irc):
+    ...
+
+@saxo.setup
+@dependencies("schema.migrate")
+def schedule(irc):
+    ...
+
+@saxo.migration("saxo_cache", 1)
+def create_cache(irc):
+    # Results of commands, when [client] results has persistent. Saxo made
+    # this itself before there were migrations, so it may already exist
+    if "saxo_cache" not in irc.db:
+        irc.db["saxo_cache"].create(
+            ("key", "TEXT PRIMARY KEY"),
+            ("expires", float),
+            ("text", str))
+    irc.db.execute("CREATE INDEX IF NOT EXISTS saxo_cache_expires " +
+        "ON saxo_cache (expires)")
+
+@saxo.migration("saxo_instances", 1)
+def create_instances(irc):
+    irc.db["saxo_instances"].create(
+        ("pid", int))
+
+@saxo.migration("saxo_periodic", 1)
+def create_periodic(irc):
+    columns = (("name", "TEXT PRIMARY KEY"),
+               ("period", int),
+               ("recent", int),
+               ("command", bytes),
+               ("args", bytes))
+    if "saxo_periodic" not in irc.db:
+        irc.db["saxo_periodic"].create(*columns)
+        return
+
     sqlite3_schema = [(0, 'name', 'TEXT', 0, None, 1),
                       (1, 'period', 'INTEGER', 0, None, 0),
                       (2, 'recent', 'INTEGER', 0, None, 0),
                       (3, 'command', 'BLOB', 0, None, 0),
                       (4, 'args', 'BLOB', 0, None, 0)]
+    if list(irc.db["saxo_periodic"].schema()) == sqlite3_schema:
+        return
 
-    if "saxo_periodic" in irc.db:
-        schema = list(irc.db["saxo_periodic"].schema())
-        if schema != sqlite3_schema:
-            del irc.db["saxo_periodic"]
+    # An older table is remade, keeping the columns that it shares
+    fields = irc.db["saxo_periodic"].fields()
+    irc.db.execute("ALTER TABLE saxo_periodic RENAME TO saxo_periodic_old")
+    irc.db["saxo_periodic"].create(*columns)
+    shared = ",".join(a for (a, b) in columns if a in fields)
+    if shared:
+        irc.db.execute("INSERT OR REPLACE INTO saxo_periodic (%s) " % shared +
+            "SELECT %s FROM saxo_periodic_old" % shared)
+    del irc.db["saxo_periodic_old"]
 
-    if "saxo_periodic" not in irc.db:
-        irc.db["saxo_periodic"].create(("name", "TEXT PRIMARY KEY"),
-                                       ("period", int),
-                                       ("recent", int),
-                                       ("command", bytes),
-                                       ("args", bytes))
+@saxo.migration("saxo_periodic", 2)
+def missed_periodic(irc):
+    # What the scheduler does with runs that it missed. See scheduler.runs
+    irc.db.execute("ALTER TABLE saxo_periodic " +
+        "ADD COLUMN missed INTEGER DEFAULT 1")
 
-@saxo.setup
-def schedule(irc):
-    if not "saxo_schedule" in irc.db:
-        irc.db["saxo_schedule"].create(
-            ("unixtime", int),
-            ("command", bytes),
-            ("args", bytes))
+@saxo.migration("saxo_periodic", 3)
+def cron_periodic(irc):
+    # A task may have a cron expression instead of a period, and jitter
+    # seconds at most are added to each of its runs at random. next is when
+    # it's due, so that the scheduler doesn't have to work it out, and the
+    # scheduler fills it in when it's NULL
+    for column in ("cron TEXT", "jitter INTEGER DEFAULT 0", "next INTEGER"):
+        irc.db.execute("ALTER TABLE saxo_periodic ADD COLUMN %s" % column)
+    irc.db.execute("CREATE INDEX IF NOT EXISTS saxo_periodic_next " +
+        "ON saxo_periodic (next)")
+
+@saxo.migration("saxo_schedule", 1)
+def create_schedule(irc):
+    irc.db["saxo_schedule"].create(
+        ("unixtime", int),
+        ("command", bytes),
+        ("args", bytes))
+
+@saxo.migration("saxo_schedule", 2)
+def index_schedule(irc):
+    # The scheduler looks for commands that are due on every tick
+    irc.db.execute("CREATE INDEX IF NOT EXISTS saxo_schedule_unixtime " +
+        "ON saxo_schedule (unixtime)")
@@ -3,31 +3,95 @@
 
 import os.path
 import saxo
+import threading
 import time
 
-@saxo.setup
-def setup(irc):
-    path = os.path.join(irc.base, "database.sqlite3")
+# Nicks seen since saxo_seen was last written to, as nick: (unixtime, channel)
+# Written every interval seconds, once there are size nicks, and on :flush
+interval = 30
+size = 256
+
+recent = {}
+written = [time.time()]
+# Reentrant, because a signal can cause a flush during a flush
+lock = threading.RLock()
+
+def write(base):
+    # Nicks are only removed from recent once they've been written, so that
+    # a write which fails, e.g. on a busy database, is tried again later
+    with lock:
+        seen = dict(recent)
+        written[0] = time.time()
+    if not seen:
+        return
+
+    path = os.path.join(base, "database.sqlite3")
     with saxo.database(path) as db:
-        if "saxo_seen" not in db:
-            db["saxo_seen"].create(
-                ("nick", "TEXT PRIMARY KEY"),
-                ("unixtime", int),
-                ("channel", str))
-        # TODO: Drop nicknames seen more than a year ago
+        if "saxo_seen" in db:
+            # Writes can overlap, so an older one mustn't undo a newer one
+            db.executemany("INSERT OR IGNORE INTO saxo_seen " +
+                "(nick,unixtime,channel,folded) VALUES(?,?,?,?)",
+                [(nick, unixtime, channel, saxo.casefold(nick))
+                 for (nick, (unixtime, channel)) in seen.items()])
+            db.executemany("UPDATE saxo_seen SET unixtime = ?, channel = ? " +
+                "WHERE nick = ? AND unixtime <= ?",
+                [(unixtime, channel, nick, unixtime)
+                 for (nick, (unixtime, channel)) in seen.items()])
+            db.commit()
+
+    with lock:
+        for nick, value in seen.items():
+            # Unless it was seen again while this was being written
+            if recent.get(nick) == value:
+                del recent[nick]
+
+@saxo.migration("saxo_seen", 1)
+def create(irc):
+    irc.db["saxo_seen"].create(
+        ("nick", "TEXT PRIMARY KEY"),
+        ("unixtime", int),
+        ("channel", str))
 
-        if "saxo_private" not in db:
-            db["saxo_private"].create(
-                ("channel", "TEXT PRIMARY KEY"))
+@saxo.migration("saxo_seen", 2)
+def index(irc):
+    # This made an index on CASEFOLD(nick), which 3 replaces with the
+    # folded column. It does nothing now, so that new databases don't make
+    # an index only to drop it again
+    ...
+
+@saxo.migration("saxo_seen", 3)
+def fold(irc):
+    # The casefolded nick is kept in its own column, because an index on
+    # CASEFOLD(nick) can't be written without that function, which only
+    # saxo has, and not the sqlite3 shell or other tools
+    irc.db.execute("DROP INDEX IF EXISTS saxo_seen_nick")
+    irc.db.execute("ALTER TABLE saxo_seen ADD COLUMN folded TEXT")
+    nicks = list(irc.db.query("SELECT nick FROM saxo_seen"))
+    irc.db.executemany("UPDATE saxo_seen SET folded = ? WHERE nick = ?",
+        [(saxo.casefold(nick), nick) for (nick,) in nicks])
+    irc.db.execute("CREATE INDEX saxo_seen_folded ON saxo_seen (folded)")
+
+@saxo.migration("saxo_seen", 4)
+def index_unixtime(irc):
+    # Old rows are deleted a thousand at a time, each found by unixtime
+    irc.db.execute("CREATE INDEX IF NOT EXISTS saxo_seen_unixtime " +
+        "ON saxo_seen (unixtime)")
+
+@saxo.migration("saxo_private", 1)
+def create_private(irc):
+    irc.db["saxo_private"].create(
+        ("channel", "TEXT PRIMARY KEY"))
 
 @saxo.event("PRIVMSG")
 def record(irc):
     if irc.sender.startswith("#"):
-        path = os.path.join(irc.base, "database.sqlite3")
-        with saxo.database(path) as db:
-            if "saxo_seen" in db:
-                # TODO: db["saxo_seen"].replace
-                command = "INSERT OR REPLACE INTO saxo_seen" + \
-                    " (nick,unixtime,channel) VALUES(?,?,?)"
-                db.execute(command, irc.nick, int(time.time()), irc.sender)
-                db.commit()
+        now = time.time()
+        with lock:
+            recent[irc.nick] = (int(now), irc.sender)
+            due = (len(recent) >= size) or ((now - written[0]) >= interval)
+        if due:
+            write(irc.base)
+
+@saxo.event(":flush")
+def flush(irc):
+    write(irc.base)
@@ -4,28 +4,78 @@
 import os.path
 import saxo
 
+# Casefolded nicks with messages waiting, so that nobody else costs a query
+pending = set()
+
+def dependencies(*deps):
+    def decorator(function):
+        function.saxo_deps = deps
+        return function
+    return decorator
+
+@saxo.migration("saxo_to", 1)
+def create(irc):
+    irc.db["saxo_to"].create(
+        ("sender", str),
+        ("recipient", str),
+        ("unixtime", int),
+        ("channel", str),
+        ("message", str))
+
+@saxo.migration("saxo_to", 2)
+def index(irc):
+    # This made an index on CASEFOLD(recipient), which 3 replaces with the
+    # folded column. It does nothing now, so that new databases don't make
+    # an index only to drop it again
+    ...
+
+@saxo.migration("saxo_to", 3)
+def fold(irc):
+    # As with saxo_seen, the casefolded recipient has its own column, so
+    # that the index doesn't need CASEFOLD, which only saxo has
+    irc.db.execute("DROP INDEX IF EXISTS saxo_to_recipient")
+    irc.db.execute("ALTER TABLE saxo_to ADD COLUMN folded TEXT")
+    rows = list(irc.db.query("SELECT rowid, recipient FROM saxo_to"))
+    irc.db.executemany("UPDATE saxo_to SET folded = ? WHERE rowid = ?",
+        [(saxo.casefold(recipient), rowid) for (rowid, recipient) in rows])
+    irc.db.execute("CREATE INDEX saxo_to_folded ON saxo_to (folded)")
+
+@saxo.migration("saxo_to", 4)
+def index_unixtime(irc):
+    # As with saxo_seen, old messages are deleted in batches by unixtime
+    irc.db.execute("CREATE INDEX IF NOT EXISTS saxo_to_unixtime " +
+        "ON saxo_to (unixtime)")
+
 @saxo.setup
+@dependencies("schema.migrate")
 def setup(irc):
     path = os.path.join(irc.base, "database.sqlite3")
     with saxo.database(path) as db:
-        if "saxo_to" not in db:
-            db["saxo_to"].create(
-                ("sender", str),
-                ("recipient", str),
-                ("unixtime", int),
-                ("channel", str),
-                ("message", str))
-        # TODO: Drop messages more than a year old
+        pending.clear()
+        query = "SELECT DISTINCT folded FROM saxo_to"
+        for (recipient,) in db.query(query):
+            pending.add(recipient)
+
+@saxo.event(":to")
+def waiting(irc):
+    pending.add(saxo.casefold(irc.parameters[0]))
 
 @saxo.event("PRIVMSG")
 def deliver(irc):
+    recipient = saxo.casefold(irc.nick)
+    if recipient not in pending:
+        return
+
     path = os.path.join(irc.base, "database.sqlite3")
     with saxo.database(path) as db:
-        query = "SELECT * FROM saxo_to WHERE recipient = ?"
-        for row in db.query(query, irc.nick):
-            print(row)
-            recipient = row[1]
-            sender = row[0]
-            message = row[4]
-            irc.say("%s: <%s> %s" % (recipient, sender, message))
-            del db["saxo_to"][row]
+        query = "SELECT rowid, sender, recipient, unixtime, channel, " + \
+            "message FROM saxo_to WHERE folded = ?"
+        rows = list(db.query(query, recipient))
+        for (rowid, sender, nick, unixtime, channel, message) in rows:
+            irc.say("%s: <%s> %s" % (nick, sender, message))
+
+        # Delivered messages are deleted in the same transaction
+        command = "DELETE FROM saxo_to WHERE rowid = ?"
+        db.executemany(command, [(row[0],) for row in rows])
+        db.commit()
+    pending.discard(recipient)
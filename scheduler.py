@@ -1,108 +1,473 @@
 # http://inamidst.com/saxo/
 # Created by Sean B. Palmer
 
+import heapq
+import itertools
+import math
 import os
 import queue
+import random
 import socket
 import sys
+import threading
 import time
 
 # Save PEP 3122!
 if "." in __name__:
     from . import sqlite
     from . import common
+    from . import cron
 else:
     import sqlite
     import common
+    import cron
 
-incoming = queue.Queue()
+incoming = common.Instructions()
+
+# How late things have fired, by table, counted by the most seconds late
+# that they were. The scheduler also notes how many things are waiting,
+# when the next is due, and how long ticks take, after each tick
+buckets = ((0.01, "10ms"), (0.1, "100ms"), (1, "1s"), (10, "10s"),
+           (60, "1m"), (600, "10m"), (None, "more"))
+measures = {
+    "running": False,
+    "pending": {"saxo_periodic": 0, "saxo_schedule": 0},
+    "deadline": None,
+    "lag": {},
+    "ticks": 0,
+    "ticking": 0.0,
+    "longest": 0.0,
+    "latest": 0.0
+}
+measures_lock = threading.Lock()
+
+def stats():
+    # Copies of the measures, and how far behind the scheduler is
+    with measures_lock:
+        result = dict(measures)
+        result["pending"] = dict(measures["pending"])
+        result["lag"] = {table: dict(counts)
+            for (table, counts) in measures["lag"].items()}
+
+    deadline = result.pop("deadline")
+    if deadline is None:
+        result["behind"] = 0.0
+    else:
+        result["behind"] = max(0.0, time.time() - deadline)
+    return result
+
+class Heap(object):
+    # Items by the time that they're due, soonest first
+    def __init__(self):
+        self.heap = []
+        # Keeps items with the same time in the order they were added
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def clear(self):
+        self.heap[:] = []
+
+    def push(self, when, item):
+        heapq.heappush(self.heap, (when, next(self.counter), item))
+
+    def deadline(self):
+        # The time that the next item is due, or None
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    def due(self, now):
+        # Removes and returns the items due at or before now
+        items = []
+        while self.heap and (self.heap[0][0] <= now):
+            items.append(heapq.heappop(self.heap)[2])
+        return items
+
+class Wheel(object):
+    # Items in hierarchical timing wheels, by the whole second that they're
+    # due, so that adding and removing an item costs the same however many
+    # there are. Level n has a slot for each of 64 ** n seconds, and when
+    # the time gets to a slot its items go down to the level below. Items
+    # later than the top level are kept in a heap until it gets to them
+    def __init__(self, slots=64, levels=4, now=None):
+        self.slots = slots
+        self.spans = [slots ** n for n in range(levels + 1)]
+        self.levels = [[[] for slot in range(slots)]
+            for level in range(levels)]
+        self.counts = [0] * levels
+        self.later = []
+        self.counter = itertools.count()
+        # Everything up to and including this second has been removed
+        if now is None:
+            now = time.time()
+        self.time = math.ceil(now) - 1
+        self.ready = []
+
+    def __len__(self):
+        return sum(self.counts) + len(self.later) + len(self.ready)
+
+    def clear(self):
+        for level in self.levels:
+            for slot in level:
+                slot[:] = []
+        self.counts = [0] * len(self.levels)
+        self.later[:] = []
+        self.ready[:] = []
+
+    def push(self, when, item):
+        # Rounded up, so nothing is ever removed before it's due
+        self.place(math.ceil(when), item)
+
+    def place(self, second, item):
+        if second <= self.time:
+            self.ready.append(item)
+            return
+
+        # The lowest level where the second differs only in its own slot
+        for n, level in enumerate(self.levels):
+            span = self.spans[n + 1]
+            if (second // span) == (self.time // span):
+                level[(second // self.spans[n]) % self.slots].append(
+                    (second, item))
+                self.counts[n] += 1
+                return
+        heapq.heappush(self.later, (second, next(self.counter), item))
+
+    def deadline(self):
+        # The time of the next item, or of the next slot that has to be
+        # moved down a level, whichever is sooner, or None
+        if self.ready:
+            return self.time
+        for n, count in enumerate(self.counts):
+            if not count:
+                continue
+            if n == 0:
+                level = self.levels[0]
+                for second in range(self.time + 1, self.time + self.slots + 1):
+                    if level[second % self.slots]:
+                        return second
+            span = self.spans[n]
+            return (self.time // span + 1) * span
+        if self.later:
+            return self.later[0][0]
+        return None
+
+    def move(self, second):
+        # Items in the heap go into the wheels once it's their turn
+        self.time = second
+        top = self.spans[-1]
+        while self.later and (self.later[0][0] // top <= second // top):
+            when, index, item = heapq.heappop(self.later)
+            self.place(when, item)
+
+    def advance(self):
+        # Moves on, returning what's due at the new time. With anything in
+        # level 0 that's the next second, and otherwise it's the next slot
+        # of the lowest level with anything in it, or the heap's next item
+        for n, count in enumerate(self.counts):
+            if count:
+                span = self.spans[n]
+                self.move((self.time // span + 1) * span)
+                break
+        else:
+            top = self.spans[-1]
+            self.move(max(self.time // top + 1, self.later[0][0] // top) * top)
+
+        for n in range(len(self.levels) - 1, 0, -1):
+            if (self.time % self.spans[n]) == 0:
+                index = (self.time // self.spans[n]) % self.slots
+                slot = self.levels[n][index]
+                self.counts[n] -= len(slot)
+                items, slot[:] = slot[:], []
+                for second, item in items:
+                    self.place(second, item)
+
+        slot = self.levels[0][self.time % self.slots]
+        self.counts[0] -= len(slot)
+        items = [item for (second, item) in slot]
+        slot[:] = []
+        return items
+
+    def due(self, now):
+        # Removes and returns the items due at or before now
+        items, self.ready = self.ready, []
+        second = math.floor(now)
+        while self.time < second:
+            deadline = self.deadline()
+            if (deadline is None) or (deadline > second):
+                self.move(second)
+                items.extend(self.ready)
+                self.ready = []
+                break
+            items.extend(self.advance())
+            items.extend(self.ready)
+            self.ready = []
+        return items
+
+backends = {"heap": Heap, "wheel": Wheel}
+
+# Periodic tasks run whenever the time is a multiple of their period, or
+# whenever their cron expression matches, and then up to jitter seconds on
+def next_periodic(period, recent):
+    return (recent // period + 1) * period
+
+def next_run(period, expression, recent, jitter=0):
+    # When a task is next due after its recent run, or None for never
+    if expression is None:
+        due = next_periodic(period, recent)
+        following = due + period
+    else:
+        expression = cron.parse(expression)
+        due = expression.next(recent)
+        following = None if (due is None) else expression.next(due)
+    if jitter and (due is not None):
+        # Kept before the run after, or that run would be skipped
+        if following is not None:
+            jitter = min(jitter, following - due - 1)
+        due += random.randint(0, jitter)
+    return due
+
+def missed_runs(period, expression, recent, now, limit):
+    # Runs due since the recent one, other than the latest, up to limit
+    if expression is None:
+        return min(max(0, int(now) // period - recent // period - 1), limit)
+
+    expression = cron.parse(expression)
+    due = expression.next(recent)
+    count = 0
+    while count < limit:
+        due = expression.next(due)
+        if (due is None) or (due > now):
+            break
+        count += 1
+    return count
+
+def runs(missed, count):
+    # How many times to run a task, when count runs have been missed. The
+    # task says what to do then: 0 skips them all until the next run is
+    # due, 1 runs once, and more runs up to that many times to catch up
+    if not count:
+        return 1
+    return min(count + 1, missed)
 
 class Scheduler(object):
-    def __init__(self, client):
+    # Keeps what's scheduled in memory, by when it's due, and sleeps until
+    # then or until there's an instruction. The database is only read when
+    # loading, and written when something is added or fired
+    def __init__(self, client, backend="heap"):
         self.client = client
-        self.duration = 0.5
         self.connections = 0
         self.connected = False
+        # Names of the connected networks, or None for the only network
+        self.networks = set()
         self.running = False
 
+        # Heap keeps exact times, and Wheel is quicker with many items
+        self.queue = backends.get(backend, Heap)()
+        # Periodic tasks by name, as their saxo_periodic columns from period
+        # to jitter, and a token. The token is in the queue too, and changes
+        # when the task does
+        self.periodic = {}
+        self.tokens = itertools.count()
+        # Number of reminders from saxo_schedule in the queue
+        self.scheduled = 0
+        # Longest wait, in case the clock is changed
+        self.longest = 60
+
     def message(self, msg):
         self.client.put(("message", "Scheduler: %s" % msg))
 
+    def load(self):
+        # Reads everything waiting in the database
+        # Saxo asks for this once plugins have set up the tables
+        self.queue.clear()
+        self.periodic.clear()
+        self.scheduled = 0
+
+        if "saxo_periodic" in self.db:
+            # Tasks without a next run, such as those made by plugins, are
+            # given one now
+            unknown = []
+            for row in self.db["saxo_periodic"].rows():
+                due = self.add_periodic(row)
+                if row[-1] is None:
+                    unknown.append((due, row[0]))
+            if unknown:
+                self.db.executemany("UPDATE saxo_periodic " +
+                    "SET next = ? WHERE name = ?", unknown)
+                self.db.commit()
+
+        if "saxo_schedule" in self.db:
+            for (unixtime, command, args) in self.db["saxo_schedule"].rows():
+                item = ("schedule", unixtime, command, args)
+                self.queue.push(unixtime, item)
+                self.scheduled += 1
+
+    def add_periodic(self, row):
+        # Returns when the task is next due, which is worked out from its
+        # recent run unless the row has it already
+        name, period, recent, command, args = row[:5]
+        missed, expression, jitter, due = row[5:]
+        if due is None:
+            due = next_run(period, expression, recent, jitter)
+        token = next(self.tokens)
+        self.periodic[name] = tuple(row[1:-1]) + (token,)
+        if due is not None:
+            self.queue.push(due, ("periodic", name, token, due))
+        return due
+
+    def add_schedule(self, row):
+        if "saxo_schedule" not in self.db:
+            return
+        self.db.execute("INSERT INTO saxo_schedule VALUES(?,?,?)", *row)
+        self.db.commit()
+        unixtime, command, args = row
+        self.queue.push(unixtime, ("schedule", unixtime, command, args))
+        self.scheduled += 1
+
+    def timeout(self):
+        # Seconds to wait for an instruction, or None to wait until there is
+        if not (self.connected and self.running):
+            return None
+        deadline = self.queue.deadline()
+        if deadline is None:
+            return None
+        return min(max(0, deadline - time.time()), self.longest)
+
     # TODO: Make a monotonic version of time.time()
-    def tick(self):
-        start = time.time()
-        # Check for new scheduled commands
-        # TODO: New periodic commands
+    def tick(self, wait=True):
+        # Without wait, the caller is responsible for calling tick again
+        # when there's an instruction, or after timeout() seconds
+        instructions = []
+        if wait:
+            try: instructions.append(incoming.get(timeout=self.timeout()))
+            except queue.Empty:
+                ...
+
+        # The tick is timed from here, after waiting
+        started = time.monotonic()
         while True:
-            try: a, b = incoming.get(timeout=self.duration / 6)
+            try: instructions.append(incoming.get_nowait())
             except queue.Empty:
                 break
-            else:
-                if a == "connected":
-                    self.connections += 1
-                    self.message("connected (%s)" % self.connections)
-                    self.connected = True
-                elif a == "disconnected":
-                    self.message("disconnected, and stopped")
-                    self.connected = False
-                    self.running = False
-                elif a == "start":
-                    if self.connected:
-                        self.message("started at tick %s" % start)
-                        self.running = True
-                elif a == "stop":
-                    self.message("stopped")
-                    self.running = False
-                elif a == "schedule.add":
-                    if "saxo_schedule" in self.db:
-                        self.db["saxo_schedule"].insert(b)
-                else:
-                    self.message("unknown instruction: %s" % a)
-
-                elapsed = time.time() - start
-                if elapsed > (self.duration / 3):
-                    break
+        for (a, b) in instructions:
+            self.instruct(a, b)
 
         if self.connected and self.running:
-            # Periodic commands
-            if "saxo_periodic" in self.db:
-                deletions = []
-                additions = []
-                periodic = self.db["saxo_periodic"].rows(order="recent")
-                for (name, period, recent, command, args) in periodic:
-                    # find next %0 point after start
-                    unixtime = recent - (recent % period) + period
-                    if unixtime > int(start):
-                        continue
-                    cmd = command.decode("ascii")
-                    self.client.put((cmd,) + common.b64unpickle(args))
-                    deletions.append((name, period, recent, command, args))
-                    additions.append((name, period, int(start), command, args))
-
-                for deletion in deletions:
-                    del self.db["saxo_periodic"][deletion]
-                for addition in additions:
-                    self.db["saxo_periodic"].insert(addition)
-
-            # Scheduled commands
-            if "saxo_schedule" in self.db:
-                deletions[:] = []
-                schedule = self.db["saxo_schedule"].rows(order="unixtime")
-                for (unixtime, command, args) in schedule:
-                    if unixtime > start:
+            self.fire(time.time())
+        self.measure(time.monotonic() - started)
+        return True
+
+    def measure(self, duration):
+        with measures_lock:
+            measures["running"] = self.connected and self.running
+            measures["pending"]["saxo_periodic"] = len(self.periodic)
+            measures["pending"]["saxo_schedule"] = self.scheduled
+            measures["deadline"] = self.queue.deadline()
+            measures["ticks"] += 1
+            measures["ticking"] += duration
+            measures["longest"] = max(measures["longest"], duration)
+            measures["latest"] = duration
+
+    def lag(self, lags):
+        # Counts each (table, seconds late) in the bucket where it fits
+        with measures_lock:
+            for (table, late) in lags:
+                if table not in measures["lag"]:
+                    counts = {label: 0 for (most, label) in buckets}
+                    counts["max"] = 0.0
+                    measures["lag"][table] = counts
+                counts = measures["lag"][table]
+                for (most, label) in buckets:
+                    if (most is None) or (late <= most):
+                        counts[label] += 1
                         break
-                    cmd = command.decode("ascii")
-                    self.client.put((cmd,) + common.b64unpickle(args))
-                    deletions.append((unixtime, command, args))
+                counts["max"] = max(counts["max"], late)
 
-                for deletion in deletions:
-                    del self.db["saxo_schedule"][deletion]
+    def instruct(self, a, b):
+        if a == "connected":
+            self.connections += 1
+            self.networks.add(b)
+            self.message("connected (%s)" % self.connections)
+            self.connected = True
+        elif a == "disconnected":
+            self.networks.discard(b)
+            if self.networks:
+                self.message("disconnected from %s" % b)
+            else:
+                self.message("disconnected, and stopped")
+                self.connected = False
+                self.running = False
+        elif a == "start":
+            if self.connected:
+                self.message("started at tick %s" % time.time())
+                self.running = True
+        elif a == "stop":
+            self.message("stopped")
+            self.running = False
+        elif a == "load":
+            self.load()
+        elif a == "periodic.add":
+            self.add_periodic(b)
+        elif a == "schedule.add":
+            self.add_schedule(b)
+        else:
+            self.message("unknown instruction: %s" % a)
 
-        elapsed = time.time() - start
-        if elapsed < self.duration:
-            time.sleep(self.duration - elapsed)
+    def fire(self, now):
+        # Latest time of anything fired from saxo_schedule
+        fired = None
+        # Periodic tasks that were due, whether run or skipped, by name and
+        # when they're next due
+        recent = []
+        lags = []
+        for item in self.queue.due(now):
+            if item[0] == "schedule":
+                unixtime, command, args = item[1:]
+                fired = unixtime if (fired is None) else max(fired, unixtime)
+                self.scheduled -= 1
+                lags.append(("saxo_schedule", max(0, now - unixtime)))
+                times = 1
+            else:
+                # Unless the task has changed since this was added
+                name, token, due = item[1:]
+                task = self.periodic.get(name)
+                if (task is None) or (task[-1] != token):
+                    continue
+                lags.append(("saxo_periodic", max(0, now - due)))
+                period, previous, command, args, missed, expression, jitter = \
+                    task[:-1]
+                count = missed_runs(period, expression, previous, now,
+                    max(missed, 1))
+                times = runs(missed, count)
+                row = (name, period, int(now), command, args, missed,
+                    expression, jitter, None)
+                recent.append((name, self.add_periodic(row)))
 
-        return True
+            cmd = command.decode("ascii")
+            for n in range(times):
+                self.client.put((cmd,) + common.b64unpickle(args))
+
+        # Both are written in one transaction, so a task is never lost
+        if recent and ("saxo_periodic" in self.db):
+            query = "UPDATE saxo_periodic SET recent = ?, next = CASE name "
+            query += "WHEN ? THEN ? " * len(recent)
+            query += "END WHERE name IN (%s)" % ",".join("?" * len(recent))
+            params = [int(now)]
+            for (name, due) in recent:
+                params.extend((name, due))
+            params.extend(name for (name, due) in recent)
+            self.db.execute(query, *params)
+        if (fired is not None) and ("saxo_schedule" in self.db):
+            # Everything due up to then has been fired, whichever the queue
+            self.db.execute("DELETE FROM saxo_schedule WHERE unixtime <= ?",
+                fired)
+        if recent or (fired is not None):
+            self.db.commit()
+        if lags:
+            self.lag(lags)
 
     def tock(self):
         ...
@@ -110,6 +475,79 @@ class Scheduler(object):
     def start(self, base):
         database_filename = os.path.join(base, "database.sqlite3")
         with sqlite.Database(database_filename) as self.db:
+            # Saxo sends load once plugins have migrated the tables
             self.message("initialised, waiting for instructions")
             while self.tick():
                 self.tock()
+
+def test():
+    # Wheel removes the same items as a heap, with times rounded up
+    for seed in range(40):
+        rnd = random.Random(seed)
+        now = rnd.uniform(0, 2 ** 31)
+        wheel = Wheel(slots=rnd.choice((2, 4, 64)),
+            levels=rnd.choice((1, 2, 4)), now=now)
+        heap = Heap()
+        for step in range(200):
+            for n in range(rnd.randint(0, 4)):
+                when = now + rnd.choice((rnd.uniform(-5, 5),
+                    rnd.uniform(0, 5000), rnd.uniform(0, 10 ** 7)))
+                wheel.push(when, (step, n))
+                heap.push(math.ceil(when), (step, n))
+            now += rnd.choice((0, 0.5, 1, 60, rnd.uniform(0, 10 ** 6)))
+            assert sorted(wheel.due(now)) == sorted(heap.due(math.floor(now)))
+            assert len(wheel) == len(heap)
+
+    # Items on the boundaries of spans, and past the top level, are due
+    # neither early nor late
+    seconds = (0, 1, 3, 4, 5, 15, 16, 17, 63, 64, 65, 100, 256, 1000)
+    wheel = Wheel(slots=4, levels=2, now=0)
+    for second in seconds:
+        wheel.push(second, second)
+    assert len(wheel.later) >= 4
+    assert len(wheel) == len(seconds)
+    for second in range(0, 1001):
+        due = wheel.due(second)
+        assert due == ([second] if (second in seconds) else []), second
+    assert len(wheel) == 0
+    assert wheel.deadline() is None
+
+    # The time of the item in the heap is the deadline, when it's alone
+    wheel = Wheel(slots=4, levels=2, now=0)
+    wheel.push(1000, "later")
+    assert wheel.deadline() == 1000
+    assert wheel.due(999) == []
+    assert wheel.due(1000) == ["later"]
+
+    # Jitter keeps each run between when it's due and the run after
+    for period, expression in ((60, None), (None, "*/5 * * * *")):
+        for n in range(100):
+            recent = random.randint(0, 2 ** 31)
+            due = next_run(period, expression, recent)
+            following = next_run(period, expression, due)
+            jittered = next_run(period, expression, recent, 3600)
+            assert due <= jittered < following
+
+    class Client(list):
+        def put(self, item):
+            self.append(item)
+
+    # Periodic tasks that change, or go, before they're due don't run
+    args = common.b64pickle(())
+    for backend in sorted(backends):
+        sched = Scheduler(Client(), backend)
+        sched.db = sqlite.Database(":memory:")
+        if backend == "wheel":
+            sched.queue = Wheel(now=1000)
+        sched.add_periodic(("a", 10, 1000, b"a", args, 1, None, 0, None))
+        sched.add_periodic(("a", 20, 1000, b"b", args, 1, None, 0, None))
+        sched.add_periodic(("c", 10, 1000, b"c", args, 1, None, 0, None))
+        del sched.periodic["c"]
+        sched.fire(1015)
+        assert sched.client == []
+        sched.fire(1020)
+        assert sched.client == [("b",)]
+        sched.db.connection.close()
+
+if __name__ == "__main__":
+    test()
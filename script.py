@@ -101,6 +101,9 @@ Usage:
 
     saxo active [ directory ]
         Shows whether a bot is active
+
+    saxo stats [ directory ]
+        Shows the statistics of a running bot, one per line
 """
 
 def help(args, v):
@@ -362,6 +365,35 @@ def status(args):
     else:
         debug("running")
 
+@action
+def stats(args):
+    import socket
+
+    base = base_option(args)
+
+    if "." in __name__:
+        from .saxo import query
+    else:
+        from saxo import query
+
+    try: result = query("stats", base=base)
+    except (FileNotFoundError, ConnectionRefusedError):
+        common.error("There is no bot currently running")
+    except (EOFError, ConnectionResetError, socket.timeout):
+        common.error("The bot did not respond")
+
+    # Nested names are joined with dots, e.g. scheduler.pending.saxo_schedule
+    def flatten(prefix, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                yield from flatten(prefix + (str(key),), item)
+        else:
+            yield ".".join(prefix), value
+
+    for name, value in flatten((), result):
+        debug(name, value)
+    return 0
+
 @action
 def stop(args):
     base = base_option(args)
@@ -393,9 +425,6 @@ def stop(args):
 
 @action
 def test(args):
-    if args.directory is not None:
-        common.error("Tests cannot be run in conjunction with a directory")
-
     import queue
     import shutil
     import socket
@@ -411,6 +440,13 @@ def test(args):
     saxo_script = sys.modules["__main__"].__file__
     saxo_test_server = os.path.join(saxo.path, "test", "server.py")
 
+    # Another config in test can be used, e.g. pooled for config-pooled
+    test_config = os.path.join(saxo.path, "test", "config")
+    if args.directory is not None:
+        test_config += "-" + args.directory
+    if not os.path.isfile(test_config):
+        common.error("There is no test config: %s" % test_config)
+
     tmp = tempfile.mkdtemp()
     outgoing = queue.Queue()
 
@@ -424,6 +460,7 @@ def test(args):
     print("saxo path:", saxo.path)
     print("saxo script:", saxo_script)
     print("saxo test server:", saxo_test_server)
+    print("saxo test config:", test_config)
     print()
     sys.stdout.flush()
 
@@ -448,7 +485,6 @@ def test(args):
             print("Error creating the client configuration")
             sys.exit(1)
 
-        test_config = os.path.join(saxo.path, "test", "config")
         saxo_test_config = os.path.join(saxo_test, "config")
         with open(test_config) as f:
             with open(saxo_test_config, "w") as w:
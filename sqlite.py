@@ -1,10 +1,20 @@
 # http://inamidst.com/saxo/
 # Created by Sean B. Palmer
 
+import os.path
+import queue
 import re
 import sqlite3
+import threading
+import time
+
+# A column name, optionally followed by a direction
+ordering = re.compile(r"(?i)^[A-Za-z_][A-Za-z0-9_]*( (ASC|DESC))?$")
 
 class Table(object):
+    # Rows are fetched this many at a time
+    size = 256
+
     def __init__(self, connection, name):
         self.connection = connection
         self.name = name
@@ -13,9 +23,7 @@ class Table(object):
         return self.rows()
 
     def __delitem__(self, row):
-        fields = []
-        for field in self.schema():
-            fields.append(field[1])
+        fields = self.fields()
 
         if len(row) == len(fields):
             query = "DELETE FROM %s WHERE " % self.name
@@ -69,41 +77,289 @@ class Table(object):
             self.connection.commit()
         cursor.close()
 
-    def rows(self, order=None):
+    def many(self, command, rows, commit):
+        # Lists the rows first, so that a retry doesn't lose any
+        rows = [tuple(row) for row in rows]
+        if not rows:
+            return 0
+        args = ",".join(["?"] * len(rows[0]))
+        query = "%s INTO %s VALUES(%s)" % (command, self.name, args)
+
         cursor = self.connection.cursor()
+        cursor.executemany(query, rows)
+        if commit:
+            self.connection.commit()
+        cursor.close()
+        return len(rows)
+
+    def insert_many(self, rows, commit=True):
+        return self.many("INSERT", rows, commit)
+
+    def upsert_many(self, rows, commit=True):
+        # Rows replace any with the same primary key or unique columns
+        return self.many("INSERT OR REPLACE", rows, commit)
+
+    def select(self, where=None, params=(), limit=None, order=None):
+        # where is SQL with ? for each of params, e.g. "unixtime <= ?"
         query = "SELECT * FROM %s" % self.name
+        if where is not None:
+            query += " WHERE %s" % where
+        if order is not None:
+            for part in order.split(","):
+                if not ordering.match(part.strip()):
+                    raise ValueError("Bad order: %s" % order)
+            query += " ORDER BY %s" % order
+        if limit is not None:
+            query += " LIMIT %s" % int(limit)
 
-        if isinstance(order, str):
-            if order.isalpha():
-                query += " ORDER BY %s" % order
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query, tuple(params))
+            while True:
+                results = cursor.fetchmany(self.size)
+                if not results:
+                    break
+                yield from results
+        finally:
+            cursor.close()
 
-        cursor.execute(query)
+    def delete(self, where=None, params=(), commit=True):
+        # Returns the number of rows deleted. Without where, deletes all
+        query = "DELETE FROM %s" % self.name
+        if where is not None:
+            query += " WHERE %s" % where
+
+        cursor = self.connection.cursor()
+        cursor.execute(query, tuple(params))
+        count = cursor.rowcount
+        if commit:
+            self.connection.commit()
+        cursor.close()
+        return count
+
+    def prune(self, where, params=(), size=1000):
+        # Deletes size rows at a time, committing each time, so that the
+        # database isn't locked for long. Returns the number of rows
+        query = "DELETE FROM %s WHERE rowid IN " % self.name
+        query += "(SELECT rowid FROM %s WHERE %s LIMIT %s)" % \
+            (self.name, where, int(size))
+
+        total = 0
         while True:
-            result = cursor.fetchone()
-            if result is None:
-                break
-            yield result
+            cursor = self.connection.cursor()
+            cursor.execute(query, tuple(params))
+            count = cursor.rowcount
+            self.connection.commit()
+            cursor.close()
+
+            total += count
+            if count < size:
+                return total
+
+    def update(self, set, where=None, params=(), commit=True):
+        # set is a dict of columns to values. Returns the number of rows
+        fields = self.fields()
+        for field in set:
+            if field not in fields:
+                raise ValueError("No such column: %s" % field)
+        columns = list(set)
+
+        query = "UPDATE %s SET " % self.name
+        query += ", ".join("%s=?" % column for column in columns)
+        if where is not None:
+            query += " WHERE %s" % where
+
+        cursor = self.connection.cursor()
+        args = tuple(set[column] for column in columns) + tuple(params)
+        cursor.execute(query, args)
+        count = cursor.rowcount
+        if commit:
+            self.connection.commit()
         cursor.close()
+        return count
+
+    def rows(self, order=None):
+        if not (isinstance(order, str) and order.isalpha()):
+            order = None
+        return self.select(order=order)
 
     def schema(self):
         cursor = self.connection.cursor()
         query = "PRAGMA table_info(%s)" % self.name
         cursor.execute(query)
-        while True:
-            result = cursor.fetchone()
-            if result is None:
-                break
-            yield result
+        results = cursor.fetchall()
         cursor.close()
+        return iter(results)
+
+    def fields(self):
+        # The column names, kept for each connection until the schema changes
+        version = self.connection.execute("PRAGMA schema_version")
+        version = version.fetchone()[0]
+
+        schemas = getattr(self.connection, "schemas", {})
+        cached = schemas.get(self.name)
+        if cached and (cached[0] == version):
+            return cached[1]
+
+        fields = tuple(field[1] for field in self.schema())
+        schemas[self.name] = (version, fields)
+        return fields
+
+# Settings for new connections. Saxo changes these from [database]
+# WAL lets readers carry on while something writes, and makes NORMAL safe
+settings = {
+    "auto_vacuum": "incremental", # Only new databases, until compact
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000, # Milliseconds to wait for a lock
+    "mmap_size": 67108864,
+    "cache_size": -8192 # Negative means KiB rather than pages
+}
+# The names of settings that were given, rather than left as the default
+configured = set()
+
+def configure(options):
+    # options is a dict, or name=value pairs separated by spaces, which is
+    # how saxo gives them to commands in $SAXO_DATABASE
+    if isinstance(options, str):
+        options = dict(option.split("=", 1) for option in options.split())
+    for name, value in options.items():
+        if name not in settings:
+            raise ValueError("Unknown database option: %s" % name)
+        if isinstance(settings[name], int):
+            value = int(value)
+        settings[name] = value
+        configured.add(name)
+
+# How often, and for how long, anything waited for a lock
+waits = {"waits": 0, "waited": 0.0, "timeouts": 0}
+waits_lock = threading.Lock()
+
+def retryable(err):
+    # SQLITE_BUSY can work once another connection is done. But not
+    # "database table is locked", from this connection, nor a write from a
+    # read transaction whose WAL snapshot is out of date
+    if str(err) != "database is locked":
+        return False
+    return getattr(err, "sqlite_errorname", "SQLITE_BUSY") == "SQLITE_BUSY"
+
+def wait(connection, method, *args):
+    # Calls method, and if the database is busy, again with busy_timeout
+    # Connections don't wait otherwise, so that the waits can be counted
+    try: return method(*args)
+    except sqlite3.OperationalError as err:
+        if not retryable(err):
+            raise
+
+    pragma = sqlite3.Connection.execute
+    pragma(connection, "PRAGMA busy_timeout = %s" % settings["busy_timeout"])
+    started = time.monotonic()
+    timeout = False
+    try: return method(*args)
+    except sqlite3.OperationalError as err:
+        timeout = retryable(err)
+        raise
+    finally:
+        pragma(connection, "PRAGMA busy_timeout = 0")
+        with waits_lock:
+            waits["waits"] += 1
+            waits["waited"] += time.monotonic() - started
+            if timeout:
+                waits["timeouts"] += 1
+
+def stats():
+    with waits_lock:
+        return dict(waits)
+
+class Cursor(sqlite3.Cursor):
+    def execute(self, *args):
+        return wait(self.connection, sqlite3.Cursor.execute, self, *args)
+
+    def executemany(self, *args):
+        return wait(self.connection, sqlite3.Cursor.executemany, self,
+            *args)
+
+class Connection(sqlite3.Connection):
+    def cursor(self, factory=Cursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        return wait(self, sqlite3.Connection.commit, self)
+
+# IRC nicknames and channels are case insensitive, with {}|^ as the lower
+# case of []\~, as in RFC 1459
+rfc1459 = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~",
+                        "abcdefghijklmnopqrstuvwxyz{}|^")
+
+def casefold(text):
+    if text is None:
+        return None
+    return text.translate(rfc1459)
+
+def connect(path, shared=False):
+    # A shared connection can be used by any thread, but only one at a time
+    # sqlite3 keeps prepared statements for each connection, by query text
+    connection = sqlite3.connect(path, timeout=0, factory=Connection,
+        check_same_thread=not shared, cached_statements=256)
+
+    # auto_vacuum first, because a new database can't change it afterwards
+    for name in ("auto_vacuum", "journal_mode", "synchronous", "mmap_size",
+                 "cache_size"):
+        connection.execute("PRAGMA %s = %s" % (name, settings[name]))
+
+    def regexp(pattern, text):
+        return re.search(pattern, text) is not None
+    connection.create_function("REGEXP", 2, regexp)
+    # Only for queries. Indexes and constraints mustn't use it, since other
+    # programs that open the database don't have it
+    connection.create_function("CASEFOLD", 1, casefold)
+
+    # Table.fields by table name
+    connection.schemas = {}
+    return connection
+
+def compact(db, pages=1024):
+    # Gives free pages back to the filesystem, and updates the statistics
+    # that the query planner uses. Returns the number of bytes reclaimed
+    db.commit()
+    def pragma(name):
+        return list(db.query("PRAGMA %s" % name))[0][0]
+
+    size = pragma("page_size")
+    before = pragma("page_count")
+    # 2 is incremental. Databases made before that was the default need a
+    # full VACUUM to change, which locks the database for as long as it
+    # takes to copy it, so that's only done when auto_vacuum is given
+    mode = str(settings["auto_vacuum"]).lower()
+    convert = ("auto_vacuum" in configured) and (mode in {"incremental", "2"})
+    current = pragma("auto_vacuum")
+    if (current != 2) and convert:
+        db.execute("PRAGMA auto_vacuum = incremental")
+        db.execute("VACUUM")
+    elif current == 2:
+        # A few pages at a time, as with Table.prune
+        free = pragma("freelist_count")
+        while free:
+            db.execute("PRAGMA incremental_vacuum(%s)" % int(pages)).fetchall()
+            free, previous = pragma("freelist_count"), free
+            if free >= previous:
+                break
+    db.execute("PRAGMA optimize").fetchall()
+    return (before - pragma("page_count")) * size
 
 class Database(object):
-    def __init__(self, path):
+    def __init__(self, path, connection=None, pool=None):
         self.path = path
-        self.connection = sqlite3.connect(path)
-
-        def regexp(pattern, text):
-            return re.search(pattern, text) is not None
-        self.connection.create_function("REGEXP", 2, regexp)
+        self.pool = pool
+        if connection is None:
+            connection = connect(path)
+        self.connection = connection
 
     def __iter__(self):
         raise NotImplemented
@@ -132,7 +388,10 @@ class Database(object):
     def __exit__(self, *args, **kargs):
         # TODO: Check for changes to commit?
         # self.connection.commit()
-        self.connection.close()
+        if self.pool is not None:
+            self.pool.give(self.connection)
+        else:
+            self.connection.close()
 
     def commit(self):
         self.connection.commit()
@@ -145,6 +404,11 @@ class Database(object):
             cursor.execute(text, args)
         return cursor
 
+    def executemany(self, text, rows):
+        cursor = self.connection.cursor()
+        cursor.executemany(text, rows)
+        return cursor
+
     def query(self, text, *args):
         cursor = self.execute(text, *args)
         # Duplicate rows are sometimes given,
@@ -160,6 +424,75 @@ class Database(object):
             previous = result
         cursor.close()
 
+class Pool(object):
+    # Connections to one database, kept open and lent to threads in turn
+    # Use "with pool.borrow() as db" in place of "with Database(path) as db"
+    def __init__(self, path, size=4):
+        self.path = path
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.borrowed = 0
+
+    def borrow(self):
+        try: connection = self.idle.get_nowait()
+        except queue.Empty:
+            connection = None
+
+        with self.lock:
+            self.borrowed += 1
+            if connection is None:
+                self.opened += 1
+        if connection is None:
+            connection = connect(self.path, shared=True)
+        return Database(self.path, connection=connection, pool=self)
+
+    def give(self, connection):
+        # Closing a connection discards what wasn't committed, so do that too
+        if connection.in_transaction:
+            connection.rollback()
+        if self.idle.qsize() >= self.size:
+            connection.close()
+            return
+        self.idle.put(connection)
+
+    def close(self):
+        while True:
+            try: connection = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "opened": self.opened,
+                "borrowed": self.borrowed,
+                "idle": self.idle.qsize()
+            }
+
+# Pools in this process, by database path
+pools = {}
+
+def pool(path, size=4):
+    # The pool for path in this process, made if necessary
+    path = os.path.abspath(path)
+    if path not in pools:
+        pools[path] = Pool(path, size)
+    return pools[path]
+
+def options():
+    # The settings, as configure takes them
+    return " ".join("%s=%s" % item for item in sorted(settings.items()))
+
+def database(path):
+    # Borrows from a pool for path in this process, if there is one
+    pool = pools.get(os.path.abspath(path))
+    if pool is not None:
+        return pool.borrow()
+    return Database(path)
+
 def test():
     import os
 
@@ -185,7 +518,94 @@ def test():
 
         del db["example"][("pqr", 5)]
         print(list(db["example"]))
+        db.commit()
+
+        assert db["example"].fields() == ("name", "size")
+        assert db["example"].insert_many([("a", 1), ("b", 2), ("c", 3)]) == 3
+        assert db["example"].upsert_many([("d", 4)]) == 1
+        rows = db["example"].select(where="size < ?", params=(4,),
+            order="size DESC", limit=2)
+        assert list(rows) == [("c", 3), ("b", 2)]
+        assert db["example"].update({"size": 0}, where="name = ?",
+            params=("b",)) == 1
+        assert db["example"].delete(where="size >= ?", params=(3,)) == 3
+        assert list(db["example"].rows(order="size")) == [("b", 0), ("a", 1)]
+        try: db["example"].update({"nonsense": 0})
+        except ValueError: ...
+        else: raise AssertionError("update of a missing column")
+
+        db.execute("ALTER TABLE example ADD COLUMN note TEXT")
+        assert db["example"].fields() == ("name", "size", "note")
+        db["example"].delete()
+        db.execute("CREATE TABLE items (name TEXT PRIMARY KEY, size INTEGER)")
+        db["items"].upsert_many([("a", 1), ("a", 2)])
+        assert list(db["items"]) == [("a", 2)]
+        db["items"].delete()
+        db.commit()
+
+        del db["items"]
+        db.execute("ALTER TABLE example DROP COLUMN note")
+
+        db["example"].insert_many(("n%s" % n, n) for n in range(25))
+        assert db["example"].prune("size < ?", (20,), size=8) == 20
+        assert len(list(db["example"])) == 5
+        assert compact(db) >= 0
+        assert list(db.query("PRAGMA auto_vacuum")) == [(2,)]
+        db["example"].delete()
+        db["example"].insert(("abc", 10))
+
+    examples = pool(filename, size=1)
+    with database(filename) as db:
+        assert list(db["example"]) == [("abc", 10)]
+        db["example"].insert(("xyz", 15), commit=False)
+    with database(filename) as db:
+        # Uncommitted changes are discarded, as when closing a connection
+        assert list(db["example"]) == [("abc", 10)]
+    assert examples.stats() == {"opened": 1, "borrowed": 2, "idle": 1}
+    examples.close()
+    del pools[os.path.abspath(filename)]
+
+    # One connection waits for another to finish writing
+    shared = connect(filename, shared=True)
+    with Database(filename, shared) as a, Database(filename) as b:
+        a.execute("BEGIN IMMEDIATE")
+        a["example"].insert(("def", 20), commit=False)
+        threading.Timer(0.1, a.commit).start()
+        b["example"].insert(("ghi", 25))
+        assert len(list(b["example"])) == 3
+    assert stats()["waits"] == 1
+
+    # But a write from a read transaction made before the other write
+    # can't work until it's rolled back, so there's no waiting for it
+    with Database(filename) as a, Database(filename) as b:
+        a.execute("BEGIN")
+        assert len(list(a["example"])) == 3
+        b["example"].insert(("jkl", 30))
+        started = time.monotonic()
+        try: a["example"].insert(("mno", 35), commit=False)
+        except sqlite3.OperationalError:
+            assert (time.monotonic() - started) < 1
+        else: raise AssertionError("wrote to an old snapshot")
+        a.connection.rollback()
+
+    os.remove(filename)
 
+    # Other auto_vacuum settings are left as they are, and so is the default
+    configure({"auto_vacuum": "none"})
+    with Database(filename) as db:
+        db["example"].create(("name", str))
+        assert compact(db) >= 0
+        assert list(db.query("PRAGMA auto_vacuum")) == [(0,)]
+    settings["auto_vacuum"] = "incremental"
+    configured.discard("auto_vacuum")
+    with Database(filename) as db:
+        assert compact(db) >= 0
+        assert list(db.query("PRAGMA auto_vacuum")) == [(0,)]
+    # Giving it is what changes a database
+    configure({"auto_vacuum": "incremental"})
+    with Database(filename) as db:
+        compact(db)
+        assert list(db.query("PRAGMA auto_vacuum")) == [(2,)]
     os.remove(filename)
 
 if __name__ == "__main__":
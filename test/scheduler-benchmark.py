@@ -0,0 +1,81 @@
+# http://inamidst.com/saxo/
+# Created by Sean B. Palmer
+
+# Times a tick of the scheduler with different numbers of reminders waiting
+# Each tick adds a reminder and fires one, so that the number stays the same
+# Usage: python3 test/scheduler-benchmark.py [ticks]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+scripts = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(scripts)]
+
+import common
+import scheduler
+import sqlite
+
+class Client(object):
+    def __init__(self):
+        self.fired = 0
+
+    def put(self, instruction):
+        self.fired += 1
+
+def queue(backend, pending, ticks):
+    # Only the queue, without the database
+    now = time.time()
+    items = scheduler.backends[backend]()
+    for n in range(pending):
+        items.push(now + n + 1, n)
+
+    started = time.perf_counter()
+    for tick in range(1, ticks + 1):
+        items.push(now + pending + tick, tick)
+        items.due(now + tick)
+    return (time.perf_counter() - started) / ticks
+
+def database(backend, pending, ticks):
+    # A whole tick, with the database
+    directory = tempfile.mkdtemp()
+    now = int(time.time())
+    args = common.b64pickle(())
+    try:
+        sched = scheduler.Scheduler(Client(), backend)
+        sched.db = sqlite.Database(os.path.join(directory, "benchmark.sqlite3"))
+        sched.db["saxo_schedule"].create(
+            ("unixtime", int),
+            ("command", bytes),
+            ("args", bytes))
+        sched.db.execute("CREATE INDEX saxo_schedule_unixtime " +
+            "ON saxo_schedule (unixtime)")
+        rows = [(now + n + 1, b"ping", args) for n in range(pending)]
+        sched.db["saxo_schedule"].insert_many(rows)
+        sched.load()
+
+        started = time.perf_counter()
+        for tick in range(1, ticks + 1):
+            sched.add_schedule((now + pending + tick, b"ping", args))
+            sched.fire(now + tick)
+        elapsed = time.perf_counter() - started
+
+        if sched.client.fired != ticks:
+            raise Exception("Fired %s of %s" % (sched.client.fired, ticks))
+        sched.db.connection.close()
+        return elapsed / ticks
+    finally:
+        shutil.rmtree(directory)
+
+def main(ticks=1000):
+    print("pending   backend   queue (us)   tick (us)")
+    for pending in (100, 1000, 10000, 100000):
+        for backend in sorted(scheduler.backends):
+            a = queue(backend, pending, ticks) * 1000000
+            b = database(backend, pending, ticks) * 1000000
+            print("%7s   %-7s   %10.2f   %9.1f" % (pending, backend, a, b))
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
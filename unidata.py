@@ -0,0 +1,317 @@
+# http://inamidst.com/saxo/
+# Created by Sean B. Palmer
+
+# Loading the saxo_unicode table, and a compact copy of it for looking up
+# characters by codepoint. Commands map the file into memory instead of
+# querying the database, so every command process shares the same pages
+#
+# Also, searching saxo_unicode by name, for the chars and unicode-by-name
+# commands
+#
+# The file is a header, then a fixed width record for every codepoint up
+# to the highest, then the names and displays of all the codepoints
+
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import unicodedata
+
+magic = b"saxo unicode 1\n\x00"
+
+# magic, number of records, offset of the names
+header = struct.Struct("<16sII")
+
+# offset into the names, name size, display size, category
+# A category of b"\x00\x00" means that there's no such character
+record = struct.Struct("<IHB2s")
+
+columns = (
+    ("hexcode", str),
+    ("codepoint", int),
+    ("name", str),
+    ("current", str),
+    ("ancient", str),
+    ("category", str),
+    ("character", str),
+    ("display", str),
+    ("weight", float))
+
+surrogates = {"D800", "DB7F", "DB80", "DBFF", "DC00", "DFFF"}
+
+def weight(name, codepoint):
+    # Searches prefer short names and low codepoints
+    return min(len(name) / 60, .5) + min(codepoint / 0xFFFF, 1)
+
+def display(character, codepoint, category):
+    if category.startswith("M"):
+        # TODO: Just Mn?
+        return "\u25CC" + character
+    elif category.startswith("C") and not category.endswith("o"):
+        # Co is Private_Use, allow those
+        if 0 <= codepoint <= 0x1F:
+            return chr(codepoint + 0x2400)
+        return "<%s>" % category
+    return character
+
+def python_rows():
+    # Every assigned codepoint in all 17 planes that python knows about
+    for codepoint in range(1, 0x110000):
+        hexcode = "%04X" % codepoint
+
+        # Skip surrogates
+        if hexcode in surrogates:
+            character = ""
+        else:
+            character = chr(codepoint)
+
+        try: category = unicodedata.category(character)
+        except TypeError:
+            continue
+
+        # Unassigned, and private use outside of the BMP
+        if category == "Cn":
+            continue
+        if (category == "Co") and (codepoint > 0xFFFF):
+            continue
+
+        try: character.encode("utf-8")
+        except UnicodeEncodeError:
+            continue
+
+        try: name = unicodedata.name(character)
+        except ValueError:
+            name = "<control>"
+
+        yield (hexcode, codepoint, name, name, "", category, character,
+            display(character, codepoint, category), weight(name, codepoint))
+
+def web_rows(text):
+    # The lines of UnicodeData.txt
+    for line in text.splitlines():
+        a, b, c, d, e, f, g, h, i, j, k, l, m, n, o = line.split(";")
+        codepoint = int(a, 16)
+
+        # Skip surrogates
+        if a in surrogates:
+            character = ""
+        else:
+            character = chr(codepoint)
+
+        if b != "<control>":
+            name = b
+        else:
+            name = k or b
+
+        yield (a, codepoint, name, b, k, c, character,
+            display(character, codepoint, c), weight(name, codepoint))
+
+def create_names(db, name, table):
+    # Names by word, for searching by word prefixes. Without FTS5 in sqlite,
+    # searches scan the names instead
+    # The index is contentless, and gives rowids of the table
+    try: db.execute("CREATE VIRTUAL TABLE %s USING " % name +
+        "fts5(name, content='')")
+    except sqlite3.OperationalError:
+        return False
+    db.execute("INSERT INTO %s(rowid, name) " % name +
+        "SELECT rowid, name FROM %s" % table)
+    return True
+
+def load(db, rows, size=8192):
+    # Loads into a shadow table, which is indexed and then swapped for
+    # saxo_unicode in one transaction, so that saxo_unicode is never empty
+    for name in ("saxo_unicode_names_new", "saxo_unicode_new"):
+        del db[name]
+    db["saxo_unicode_new"].create(*columns)
+
+    insert = "INSERT INTO saxo_unicode_new VALUES(%s)" % \
+        ",".join("?" * len(columns))
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            db.executemany(insert, batch)
+            batch = []
+    if batch:
+        db.executemany(insert, batch)
+    names = create_names(db, "saxo_unicode_names_new", "saxo_unicode_new")
+    db.commit()
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for name in ("saxo_unicode_names", "saxo_unicode"):
+            del db[name]
+        db.execute("ALTER TABLE saxo_unicode_new RENAME TO saxo_unicode")
+        if names:
+            db.execute("ALTER TABLE saxo_unicode_names_new " +
+                "RENAME TO saxo_unicode_names")
+        db.execute("CREATE INDEX saxo_unicode_hexcode " +
+            "ON saxo_unicode (hexcode)")
+        db.execute("CREATE INDEX saxo_unicode_character " +
+            "ON saxo_unicode (character)")
+        db.commit()
+    except:
+        db.connection.rollback()
+        raise
+
+regex_metachar = re.compile("[%s]" % re.escape(r"$()*+.?[\]^{|}"))
+
+def scan(db, search):
+    # Matches a regular expression against every name
+    if regex_metachar.search(search):
+        pattern = search
+    else:
+        pattern = ".*".join(r"\b" + word for word in search.split(" "))
+    pattern = "(?i)" + pattern
+
+    # In the same order as lookup, by the stored weight
+    query = "SELECT * FROM saxo_unicode WHERE name REGEXP ? " + \
+        "ORDER BY weight, codepoint"
+
+    try: return list(db.query(query, pattern))
+    except:
+        # OperationalError, if e.g. regexp is "??"
+        return list(db.query(query, "(?i)" + re.escape(search)))
+
+def lookup(db, words):
+    # Names with each word as the start of a word, in order, from the index
+    match = " AND ".join('"%s"*' % word.replace('"', '""') for word in words)
+    query = "SELECT saxo_unicode.* FROM saxo_unicode_names " + \
+        "JOIN saxo_unicode " + \
+        "ON saxo_unicode.rowid = saxo_unicode_names.rowid " + \
+        "WHERE saxo_unicode_names MATCH ? ORDER BY weight, codepoint"
+
+    # The index doesn't know about order, so check that here
+    pattern = ".*".join(r"\b" + re.escape(word) for word in words)
+    regex_words = re.compile("(?i)" + pattern)
+    return [row for row in db.query(query, match)
+            if regex_words.search(row[2])]
+
+def search_by_name(db, search):
+    # Rows of saxo_unicode, best first, from the index if possible
+    words = [word for word in search.split(" ") if word]
+
+    rows = None
+    if words and (not regex_metachar.search(search)):
+        if "saxo_unicode_names" in db:
+            try: rows = lookup(db, words)
+            except sqlite3.OperationalError:
+                # The words couldn't be made into an index query
+                rows = None
+    if rows is None:
+        rows = scan(db, search)
+    return rows
+
+class Data(object):
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.identity = None
+        self.count = 0
+        self.names = 0
+
+    def open(self):
+        # Returns whether the file can be used, reopening it if replaced
+        try: status = os.stat(self.path)
+        except OSError:
+            self.close()
+            return False
+
+        identity = (status.st_ino, status.st_mtime_ns, status.st_size)
+        if identity == self.identity:
+            return True
+        self.close()
+
+        if status.st_size < header.size:
+            return False
+        with open(self.path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        check, count, names = header.unpack_from(mapped, 0)
+        if (check != magic) or (names > len(mapped)):
+            mapped.close()
+            return False
+
+        self.map = mapped
+        self.identity = identity
+        self.count = count
+        self.names = names
+        return True
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = None
+        self.identity = None
+        self.count = 0
+
+    def get(self, codepoint):
+        # Returns a row like those of saxo_unicode, or None
+        # The current and ancient names aren't kept, and are empty
+        if (self.map is None) or not (0 <= codepoint < self.count):
+            return None
+
+        position = header.size + (codepoint * record.size)
+        offset, name_size, display_size, category = \
+            record.unpack_from(self.map, position)
+        if category == b"\x00\x00":
+            return None
+
+        start = self.names + offset
+        middle = start + name_size
+        name = str(self.map[start:middle], "utf-8")
+        display = str(self.map[middle:middle + display_size], "utf-8")
+        category = str(category, "ascii")
+
+        # Surrogates have no character
+        character = "" if (category == "Cs") else chr(codepoint)
+        return ("%04X" % codepoint, codepoint, name, "", "",
+                category, character, display)
+
+    def load(self, db, text=None):
+        # Replaces saxo_unicode with the characters in text, which is
+        # UnicodeData.txt, or else those that python knows about. Then
+        # writes the file from it
+        rows = python_rows() if (text is None) else web_rows(text)
+        load(db, rows)
+        self.build(db)
+
+    def build(self, db):
+        # Writes the file from saxo_unicode, replacing any old one at once
+        query = "SELECT codepoint, name, category, display " + \
+            "FROM saxo_unicode ORDER BY codepoint"
+        rows = list(db.query(query))
+        count = (rows[-1][0] + 1) if rows else 0
+
+        records = bytearray(count * record.size)
+        names = bytearray()
+        for codepoint, name, category, display in rows:
+            name = name.encode("utf-8")[:0xFFFF]
+            display = display.encode("utf-8")[:0xFF]
+            category = category.encode("ascii")[:2].ljust(2, b" ")
+            record.pack_into(records, codepoint * record.size,
+                len(names), len(name), len(display), category)
+            names += name + display
+
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(header.pack(magic, count, header.size + len(records)))
+            f.write(records)
+            f.write(names)
+        os.replace(temporary, self.path)
+
+    def remove(self):
+        self.close()
+        try: os.remove(self.path)
+        except FileNotFoundError:
+            ...
+
+# Opened files, kept by path, so that resident commands reuse the mapping
+opened = {}
+
+def data(path):
+    if path not in opened:
+        opened[path] = Data(path)
+    return opened[path]
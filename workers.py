@@ -0,0 +1,368 @@
+# http://inamidst.com/saxo/
+# Created by Sean B. Palmer
+
+# A pool of warm python processes for running commands. Each worker has
+# already imported saxo, web, and sqlite, and forks a child per command, so
+# that a command costs a fork instead of a new interpreter
+#
+# Also, a way of running @saxo.pipe commands inside saxo itself
+
+import concurrent.futures
+import os
+import queue
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import common
+    from . import core
+else:
+    import common
+    import core
+
+def utf8dict(data):
+    return {str(key).encode("utf-8", "replace"):
+            str(value).encode("utf-8", "replace")
+            for key, value in data.items()}
+
+def python_script(path):
+    # Only scripts with a python3 shebang can run in a warm worker
+    try:
+        with open(path, "rb") as f:
+            line = f.readline(256)
+    except OSError:
+        return False
+    if not line.startswith(b"#!"):
+        return False
+    words = line[2:].split()
+    if not words:
+        return False
+    if os.path.basename(words[0]) == b"env":
+        words = words[1:]
+    if not words:
+        return False
+    name = os.path.basename(words[0])
+    return (name == b"python") or name.startswith(b"python3")
+
+class Pool(object):
+    def __init__(self, size, env):
+        self.size = size
+        self.env = env
+        self.idle = queue.Queue()
+        self.scripts = {}
+        self.lock = threading.Lock()
+        # Workers from an earlier generation are closed when they finish
+        self.generation = 0
+        self.stopped = False
+        for n in range(size):
+            self.idle.put(self.spawn())
+
+    def spawn(self):
+        worker = subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+            env=utf8dict(self.env),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        worker.generation = self.generation
+        return worker
+
+    def python(self, path):
+        try: mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+
+        with self.lock:
+            cached = self.scripts.get(path)
+        if cached and (cached[0] == mtime):
+            return cached[1]
+
+        result = python_script(path)
+        with self.lock:
+            self.scripts[path] = (mtime, result)
+        return result
+
+    def run(self, path, arg, env, timeout):
+        # Returns (outs, code), with outs None on timeout
+        # Returns None if no worker could take the command
+        # Raises PermissionError if the script isn't executable, like spawn
+        if not os.access(path, os.X_OK):
+            raise PermissionError(path)
+
+        try: worker = self.idle.get_nowait()
+        except queue.Empty:
+            return None
+
+        try:
+            request = common.b64pickle((path, arg, env, timeout))
+            worker.stdin.write(request + b"\n")
+            worker.stdin.flush()
+
+            # The worker enforces the timeout itself, so this is a backstop
+            ready = select.select([worker.stdout], [], [], timeout + 3)[0]
+            if not ready:
+                raise TimeoutError(path)
+
+            response = worker.stdout.readline()
+            if not response:
+                raise EOFError(path)
+        except TimeoutError:
+            self.replace(worker)
+            return None, 0
+        except Exception:
+            self.replace(worker)
+            return None
+
+        self.give(worker)
+        return common.b64unpickle(response.rstrip(b"\n"))
+
+    def give(self, worker):
+        if self.stopped:
+            self.close(worker)
+        elif worker.generation != self.generation:
+            self.close(worker)
+            self.idle.put(self.spawn())
+        else:
+            self.idle.put(worker)
+
+    def replace(self, worker):
+        try: worker.kill()
+        except OSError:
+            ...
+        try: worker.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            ...
+        if not self.stopped:
+            self.idle.put(self.spawn())
+
+    def close(self, worker):
+        # A worker exits when its stdin closes
+        try: worker.stdin.close()
+        except OSError:
+            ...
+        try: worker.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+            worker.wait()
+
+    def idlers(self):
+        workers = []
+        while True:
+            try: workers.append(self.idle.get_nowait())
+            except queue.Empty:
+                return workers
+
+    def restart(self):
+        # New workers, with fresh imports, e.g. on reload
+        # Busy workers are replaced as they finish
+        with self.lock:
+            self.generation += 1
+            self.scripts.clear()
+        for worker in self.idlers():
+            self.give(worker)
+
+    def stop(self):
+        # Busy workers are closed as they finish
+        self.stopped = True
+        for worker in self.idlers():
+            self.close(worker)
+
+def load(path):
+    # Returns the @saxo.pipe function of a command script, or None
+    import types
+
+    with open(path, "rb") as f:
+        source = f.read()
+    # Don't run scripts which would do their work as soon as they're loaded
+    if (b"@saxo.pipe" not in source) and (b"@saxo.command" not in source):
+        return None
+    code = compile(source, path, "exec")
+
+    name = "saxo_command_" + os.path.basename(path).replace("-", "_")
+    module = types.ModuleType(name)
+    module.__file__ = path
+
+    core.context.pipes = []
+    try: exec(code, module.__dict__)
+    finally:
+        pipes = core.context.pipes
+        core.context.pipes = None
+
+    if len(pipes) != 1:
+        return None
+    return pipes[0]
+
+class Resident(object):
+    # Runs allowed @saxo.pipe commands in threads, without a new process
+    def __init__(self, names, threads=8):
+        self.names = set(names)
+        self.functions = {}
+        self.lock = threading.Lock()
+        self.threads = threads
+        # Calls still running, including those which timed out
+        self.busy = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def function(self, path):
+        if os.path.basename(path) not in self.names:
+            return None
+
+        try: mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+
+        with self.lock:
+            cached = self.functions.get(path)
+        if cached and (cached[0] == mtime):
+            return cached[1]
+
+        function = None
+        if python_script(path):
+            try: function = load(path)
+            except Exception as err:
+                print("saxo resident: %s: %s" % (path, err), file=sys.stderr)
+        with self.lock:
+            self.functions[path] = (mtime, function)
+        return function
+
+    def clear(self):
+        with self.lock:
+            self.functions.clear()
+
+    def call(self, function, arg, env):
+        core.context.environ = env
+        try: return core.invoke(function, arg)
+        finally:
+            core.context.environ = None
+            with self.lock:
+                self.busy -= 1
+
+    def run(self, path, arg, env, timeout):
+        # Returns (outs, code) like Pool.run, or None if not resident
+        function = self.function(path)
+        if function is None:
+            return None
+
+        # When every thread is taken, perhaps by hung calls, use a process
+        with self.lock:
+            if self.busy >= self.threads:
+                return None
+            self.busy += 1
+
+        future = self.executor.submit(self.call, function, arg, env)
+        # NOTE: A thread can't be killed, so on timeout it keeps running
+        try: result = future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            return None, 0
+
+        text, code = result
+        if text is None:
+            return b"", code
+        return text.encode("utf-8", "replace") + b"\n", code
+
+def child(path, arg, env, stdin, stdout):
+    # Runs in the forked process, and never returns
+    code = 1
+    try:
+        os.dup2(stdin, 0)
+        os.dup2(stdout, 1)
+        os.close(stdin)
+        os.close(stdout)
+        sys.stdin = open(0, "r", encoding="utf-8", closefd=False)
+        sys.stdout = open(1, "w", encoding="utf-8", closefd=False)
+
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        os.environ.clear()
+        os.environ.update(env)
+        sys.argv = [path, arg]
+        sys.path[0] = os.path.dirname(path)
+
+        import runpy
+        code = 0
+        try: runpy.run_path(path, run_name="__main__")
+        except SystemExit as err:
+            if isinstance(err.code, int):
+                code = err.code
+            elif err.code is not None:
+                print(err.code, file=sys.stderr)
+                code = 1
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            code = 1
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
+
+def execute(path, arg, env, timeout):
+    stdin_read, stdin_write = os.pipe()
+    stdout_read, stdout_write = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(stdin_write)
+        os.close(stdout_read)
+        child(path, arg, env, stdin_read, stdout_write)
+
+    os.close(stdin_read)
+    os.close(stdout_write)
+
+    try: os.write(stdin_write, arg.encode("utf-8", "replace") + b"\n")
+    except OSError:
+        ...
+    os.close(stdin_write)
+
+    chunks = []
+    deadline = time.monotonic() + timeout
+    timed_out = False
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            timed_out = True
+            break
+        readable, _, _ = select.select([stdout_read], [], [], remaining)
+        if not readable:
+            continue
+        chunk = os.read(stdout_read, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(stdout_read)
+
+    if timed_out:
+        try: os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            ...
+    _, status = os.waitpid(pid, 0)
+
+    if timed_out:
+        return None, 0
+    if os.WIFEXITED(status):
+        return b"".join(chunks), os.WEXITSTATUS(status)
+    return b"".join(chunks), -os.WTERMSIG(status)
+
+def serve():
+    # Warm up the modules that commands typically use
+    import saxo
+    import sqlite
+    import web
+
+    requests = sys.stdin.buffer
+    responses = sys.stdout.buffer
+    for line in requests:
+        path, arg, env, timeout = common.b64unpickle(line.rstrip(b"\n"))
+        try: result = execute(path, arg, env, timeout)
+        except Exception as err:
+            print("saxo worker: %s: %s" % (path, err), file=sys.stderr)
+            result = b"", 1
+        responses.write(common.b64pickle(result) + b"\n")
+        responses.flush()
+
+if __name__ == "__main__":
+    serve()